@@ -3,4 +3,5 @@
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 """
 
+from .actor import Actor, Reading
 from .fritz import FritzBox
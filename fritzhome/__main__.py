@@ -7,22 +7,90 @@
 
 from __future__ import print_function, division
 
-import re
-import time
 import json
-import socket
+import time
 
 import click
 
-from .fritz import FritzBox
+from .actor import Reading
+from .fritz import FritzBox, TIMERANGES
+from .fleet import FleetPoller, load_config
+from .carbon import CarbonClient
+from .scheduler import Scheduler
+from .adaptive import AdaptivePoller
+from .delta import DeltaFilter
+from .bulk import BulkFetcher
+from .logs import SeenHashes
+from .instrumentation import format_summary
+from .exporters import (
+    CarbonExporter, InfluxExporter, PrometheusExporter, StatsdExporter,
+    StoreExporter, metric_name, reading_metrics,
+)
+from .store import (
+    TimeSeriesStore, AGGREGATES, FIELD_SCALES, parse_duration, parse_time,
+)
+
+
+def exporter_options(command):
+    """Add the options for selecting exporters to a command"""
+    options = [
+        click.option('--prometheus-port', type=int, default=None,
+                     help="Serve Prometheus metrics on this port"),
+        click.option('--influx-url', default=None,
+                     help="InfluxDB write URL, e.g. "
+                          "http://localhost:8086/write?db=smarthome"),
+        click.option('--statsd', default=None, metavar="HOST[:PORT]",
+                     help="Send gauges to this StatsD server"),
+        click.option('--carbon', default=None, metavar="HOST[:PORT]",
+                     help="Send metrics to this carbon server"),
+        click.option('--prefix', default="smarthome",
+                     help="Prefix for carbon and StatsD keys"),
+        click.option('--store', default=None, type=click.Path(file_okay=False),
+                     help="Append the values to a local store (see query)"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def build_exporters(prometheus_port, influx_url, statsd, carbon, prefix, store,
+                    include_box=False):
+    """Create the exporters selected on the command line"""
+    def address(value, default_port):
+        host, _, port = value.partition(':')
+        return host, int(port) if port else default_port
+
+    exporters = []
+    if prometheus_port:
+        exporters.append(PrometheusExporter(prometheus_port))
+    if influx_url:
+        exporters.append(InfluxExporter(influx_url))
+    if statsd:
+        host, port = address(statsd, 8125)
+        exporters.append(StatsdExporter(host, port, prefix=prefix,
+                                        include_box=include_box))
+    if carbon:
+        host, port = address(carbon, 2003)
+        exporters.append(CarbonExporter(CarbonClient(host, port),
+                                        prefix=prefix, include_box=include_box))
+    if store:
+        exporters.append(StoreExporter(TimeSeriesStore(store)))
+    return exporters
 
 
 @click.group()
 @click.option('--host', default='169.254.1.1') # fritzbox "emergency" IP
 @click.option('--username', default='smarthome')
 @click.option('--password', default='smarthome')
+@click.option('--session-cache', envvar='FRITZHOME_SESSION_CACHE',
+              type=click.Path(dir_okay=False), default=None,
+              help="File for reusing the SID between invocations")
+@click.option('--rate-limit', type=float, default=None,
+              help="Maximum requests per second to the box")
+@click.option('--profile', is_flag=True, default=False,
+              help="Show request counters and latencies on exit")
 @click.pass_context
-def cli(context, host, username, password):
+def cli(context, host, username, password, session_cache, rate_limit, profile):
     """
     FritzBox SmartHome Tool
 
@@ -32,7 +100,14 @@ def cli(context, host, username, password):
     - This CLI tool for testing
     - A carbon client for pipeing data into graphite
     """
-    context.obj = FritzBox(host, username, password)
+    context.obj = FritzBox(host, username, password,
+                           session_cache=session_cache,
+                           rate_limit=rate_limit)
+    if profile:
+        def show_profile():
+            for line in format_summary(context.obj.stats()):
+                click.echo(line, err=True)
+        context.call_on_close(show_profile)
 
 
 @cli.command()
@@ -64,27 +139,35 @@ def actors(context):
 
 @cli.command()
 @click.option('--features', type=bool, default=False, help="Show device features")
+@click.option('--workers', type=int, default=3,
+              help="Number of parallel requests to the box")
 @click.pass_context
-def energy(context, features):
+def energy(context, features, workers):
     """Display energy stats of all actors"""
     fritz = context.obj
     fritz.login()
 
-    for actor in fritz.get_actors():
+    actors = fritz.get_actors()
+    values = fritz.query_actors([actor.actor_id for actor in actors],
+                                fields=('power', 'energy'),
+                                max_workers=workers)
+    for actor in actors:
+        power = values[actor.actor_id]['power'].value
+        energy = values[actor.actor_id]['energy'].value
         if actor.temperature is not None:
             click.echo("{} ({}): {:.2f} Watt current, {:.3f} wH total, {:.2f} °C".format(
                 actor.name.encode('utf-8'),
                 actor.actor_id,
-                (actor.get_power() or 0.0) / 1000,
-                (actor.get_energy() or 0.0) / 100,
+                (power or 0.0) / 1000,
+                (energy or 0.0) / 100,
                 actor.temperature
             ))
         else:
             click.echo("{} ({}): {:.2f} Watt current, {:.3f} wH total, offline".format(
                 actor.name.encode('utf-8'),
                 actor.actor_id,
-                (actor.get_power() or 0.0) / 1000,
-                (actor.get_energy() or 0.0) / 100
+                (power or 0.0) / 1000,
+                (energy or 0.0) / 100
             ))
         if features:
             click.echo("  Features: PowerMeter: {}, Temperatur: {}, Switch: {}".format(
@@ -94,67 +177,404 @@ def energy(context, features):
 
 @cli.command()
 @click.argument('server')
-@click.option('--port', type=int, default=2003)
-@click.option('--interval', type=int, default=10)
+@click.option('--port', type=int, default=None,
+              help="Default: 2003 (plaintext) or 2004 (pickle)")
+@click.option('--protocol', type=click.Choice(['plaintext', 'pickle']),
+              default='plaintext')
+@click.option('--interval', type=int, default=10,
+              help="Seconds between ticks, aligned to the clock")
+@click.option('--energy-interval', type=int, default=None,
+              help="Seconds between energy values (default: --interval)")
+@click.option('--temperature-interval', type=int, default=None,
+              help="Seconds between temperatures (default: --interval)")
 @click.option('--prefix', default="smarthome")
+@click.option('--snapshot/--per-actor', default=True,
+              help="Read all values from one device list request per tick "
+                   "(default) or query every actor separately")
+@click.option('--adaptive', is_flag=True, default=False,
+              help="Query every actor separately, polling quiet actors "
+                   "less often (--interval is the shortest interval)")
+@click.option('--max-interval', type=int, default=300,
+              help="Longest interval of quiet actors with --adaptive")
+@click.option('--budget', type=float, default=2.0,
+              help="Maximum requests per second with --adaptive")
+@click.option('--batch-size', type=int, default=500,
+              help="Maximum number of metrics per write")
+@click.option('--spool-size', type=int, default=100000,
+              help="Metrics kept while carbon is unreachable")
+@click.option('--changes-only', is_flag=True, default=False,
+              help="Only send values that changed since they were last sent")
+@click.option('--heartbeat', type=int, default=300,
+              help="Send unchanged values at least this often (seconds) "
+                   "with --changes-only")
+@click.option('--power-deadband', type=float, default=0.0,
+              help="Power changes in Watt ignored by --changes-only")
+@click.option('--temperature-deadband', type=float, default=0.0,
+              help="Temperature changes in °C ignored by --changes-only")
 @click.pass_context
-def graphite(context, server, port, interval, prefix):
-    """Display energy stats of all actors"""
+def graphite(context, server, port, protocol, interval, energy_interval,
+             temperature_interval, prefix, snapshot, adaptive, max_interval,
+             budget, batch_size, spool_size, changes_only, heartbeat,
+             power_deadband, temperature_deadband):
+    """Send energy stats of all actors to carbon"""
     fritz = context.obj
     fritz.login()
-    sid_ttl = time.time() + 600
 
     # Find actors and create carbon keys
     click.echo(" * Requesting actors list")
-    simple_chars = re.compile('[^A-Za-z0-9]+')
     actors = fritz.get_actors()
-    keys = {}
-    for actor in actors:
-        keys[actor.name] = "{}.{}".format(
-            prefix,
-            simple_chars.sub('_', actor.name)
-        )
+
+    def carbon_key(actor):
+        """Return the carbon key prefix for an actor"""
+        return "{}.{}".format(prefix, metric_name(actor.name))
 
     # Connect to carbon
     click.echo(" * Trying to connect to carbon")
-    timeout = 2
-    sock = socket.socket()
-    sock.settimeout(timeout)
+    carbon = CarbonClient(server, port, protocol=protocol,
+                          batch_size=batch_size, spool_size=spool_size)
+    if not carbon.connect():
+        click.echo(" * Carbon unavailable, spooling metrics until it's back")
+
+    changes = None
+    if changes_only:
+        changes = DeltaFilter({
+            'power': power_deadband * 1000,
+            'temperature': temperature_deadband,
+        }, heartbeat=heartbeat)
+
+    # Fields of a Reading and the interval they are sent in
+    intervals = {
+        'power': interval,
+        'state': interval,
+        'present': interval,
+        'energy': energy_interval or interval,
+        'temperature': temperature_interval or interval,
+    }
+
+    def tick(timestamp, due):
+        """Request and send the fields due at this tick"""
+        click.echo(" * Requesting statistics")
+        if snapshot:
+            # One getdevicelistinfos call contains the values of all actors
+            actors[:] = fritz.get_actors()
+
+        now = int(timestamp)
+        hidden = dict((field, None) for field in intervals if field not in due)
+        metrics = []
+        for actor in actors:
+            if snapshot:
+                reading = actor.as_reading(now)
+                if actor.has_powermeter and reading.power is None and \
+                        reading.present is not False:
+                    # Firmware without <powermeter> in the device list
+                    reading = reading._replace(power=actor.get_power(),
+                                               energy=actor.get_energy())
+            else:
+                reading = Reading(
+                    actor.actor_id, now,
+                    actor.get_power() if 'power' in due else None,
+                    actor.get_energy() if 'energy' in due else None,
+                    None, None, None
+                )
+            reading = reading._replace(**hidden)
+            if changes is not None:
+                reading = changes.filter(reading)
+
+            if reading.power is not None and reading.energy is not None:
+                click.echo("   -> {}: {:.2f} Watt current, {:.3f} wH total".format(
+                    actor.name, reading.power / 1000, reading.energy / 100
+                ))
+            metrics.extend(
+                (key, value, now)
+                for key, value in reading_metrics(carbon_key(actor), reading)
+            )
+
+        carbon.send(metrics)
+        if changes is not None and int(timestamp) % 60 == 0:
+            click.echo(" * Changes only: {}".format(changes.stats()))
+
+    def adaptive_tick(timestamp, due):
+        """Poll the actors which are due and send their values"""
+        now = int(timestamp)
+        metrics = []
+        for ain, values in poller.poll().items():
+            reading = Reading(ain, now, values.get('power'),
+                              values.get('energy'), values.get('temperature'),
+                              values.get('state'), None)
+            if changes is not None:
+                reading = changes.filter(reading)
+            metrics.extend(
+                (key, value, now)
+                for key, value in reading_metrics(carbon_key(by_ain[ain]), reading)
+            )
+        if metrics:
+            carbon.send(metrics)
+        if int(timestamp) % 60 == 0:
+            click.echo(" * Adaptive polling: {}".format(poller.stats()))
+
+    if adaptive:
+        by_ain = dict((actor.actor_id, actor) for actor in actors)
+        poller = AdaptivePoller(fritz, actors, min_interval=interval,
+                                max_interval=max_interval, budget=budget)
+        Scheduler(1, adaptive_tick).run()
+    else:
+        Scheduler(intervals, tick).run()
+
+
+@cli.command()
+@click.option('--interval', type=int, default=10)
+@click.option('--name', default=None,
+              help="Box name for labels and tags (default: the host)")
+@click.option('--request-metrics', is_flag=True, default=False,
+              help="Also export request counters and latencies")
+@exporter_options
+@click.pass_context
+def export(context, interval, name, request_metrics, prometheus_port,
+           influx_url, statsd, carbon, prefix, store):
+    """
+    Export the values of all actors to several systems
+
+    The device list is polled once per interval and passed to all
+    selected exporters.
+    """
+    fritz = context.obj
+    name = name or context.parent.params['host']
+    exporters = build_exporters(prometheus_port, influx_url, statsd, carbon,
+                                prefix, store)
+    if not exporters:
+        raise click.UsageError("No exporter selected")
+
+    def tick(timestamp, due):
+        """Poll the box and pass the actors to all exporters"""
+        try:
+            actors = fritz.get_actors()
+        except Exception as error:
+            click.echo(" * Polling failed: {}".format(error), err=True)
+        else:
+            for exporter in exporters:
+                exporter.export(name, timestamp, actors)
+        if request_metrics:
+            stats = fritz.stats()
+            for exporter in exporters:
+                exporter.export_stats(name, timestamp, stats)
+
     try:
-        sock.connect((server, port))
-    except socket.timeout:
-        raise Exception("Took over {} second(s) to connect to {}".format(
-            timeout, server
-        ))
-    except Exception as error:
-        raise Exception("unknown exception while connecting to {} - {}".format(
-            server, error
-        ))
+        Scheduler(interval, tick).run()
+    finally:
+        for exporter in exporters:
+            exporter.close()
 
-    def send(key, value):
-        """Send a key-value-pair to carbon"""
-        now = int(time.time())
-        payload = "{} {} {}\n".format(key, value, now)
-        sock.sendall(payload)
 
-    while True:
-        if time.time() > sid_ttl:
-            click.echo(" * Requesting new SID")
-            fritz.login()
-            sid_ttl = time.time() + 600
+@cli.command()
+@click.argument('config', type=click.Path(exists=True, dir_okay=False))
+@exporter_options
+def fleet(config, prometheus_port, influx_url, statsd, carbon, prefix, store):
+    """
+    Poll all boxes listed in CONFIG concurrently
 
-        click.echo(" * Requesting statistics")
+    Without any exporter option, the values of all actors are written
+    in the carbon plaintext format to stdout, e.g. for piping them into
+    netcat.
+    """
+    exporters = build_exporters(prometheus_port, influx_url, statsd, carbon,
+                                prefix, store, include_box=True)
+
+    def output(box, timestamp, actors):
+        if exporters:
+            for exporter in exporters:
+                exporter.export(box, timestamp, actors)
+            return
+        lines = []
         for actor in actors:
-            power = actor.get_power()
-            total = actor.get_energy()
-            click.echo("   -> {}: {:.2f} Watt current, {:.3f} wH total".format(
-                actor.name, power / 1000, total / 100
-            ))
+            key = "{}.{}.{}".format(prefix, metric_name(box),
+                                    metric_name(actor.name))
+            for metric, value in reading_metrics(key, actor.as_reading(timestamp)):
+                lines.append("{} {} {}".format(metric, value, timestamp))
+        click.echo("\n".join(lines))
 
-            send(keys[actor.name] + '.current', power)
-            send(keys[actor.name] + '.total', total)
+    poller = FleetPoller(load_config(config), output)
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        poller.stop()
+    finally:
+        for exporter in exporters:
+            exporter.close()
 
-        time.sleep(interval)
+
+@cli.command()
+@click.argument('output', type=click.File('a'))
+@click.option('--range', 'timeranges', multiple=True,
+              type=click.Choice(TIMERANGES),
+              help="Time range to fetch (can be repeated, default: all)")
+@click.option('--workers', type=int, default=4,
+              help="Number of parallel requests to the box")
+@click.option('--rate', type=float, default=None,
+              help="Maximum requests per second")
+@click.option('--state', type=click.Path(dir_okay=False), default=None,
+              help="File remembering the last fetches, to skip ranges "
+                   "that can't have changed")
+@click.pass_context
+def consumption(context, output, timeranges, workers, rate, state):
+    """
+    Fetch the energy statistics of all actors
+
+    Appends one JSON object per device and time range to OUTPUT
+    ("-" for stdout) as soon as it is fetched.
+    """
+    fritz = context.obj
+    fritz.login()
+
+    deviceids = [actor.device_id for actor in fritz.get_actors()
+                 if actor.has_powermeter]
+    fetcher = BulkFetcher(fritz, timeranges=timeranges or TIMERANGES,
+                          max_workers=workers, rate_limit=rate,
+                          state_path=state)
+    counts = fetcher.run(deviceids, output)
+    click.echo(" * Fetched {fetched}, failed {failed}, skipped {skipped}".format(
+        **counts), err=True)
+
+
+@cli.command()
+@click.argument('store', type=click.Path(exists=True, file_okay=False))
+@click.argument('devices', nargs=-1)
+@click.option('--field', type=click.Choice(sorted(FIELD_SCALES)),
+              default='power')
+@click.option('--since', default='1d',
+              help="Start: time before now (30d, 12h, 15m), a date "
+                   "(2024-01-31) or a unix timestamp")
+@click.option('--until', default=None, help="End, like --since (default: now)")
+@click.option('--step', default=None,
+              help="Downsample to one value per step, e.g. 1h or 1d")
+@click.option('--aggregate', type=click.Choice(AGGREGATES), default=None,
+              help="Aggregate per step, or over the whole range without "
+                   "--step (e.g. increase of energy for the consumed Wh)")
+@click.option('--format', type=click.Choice(['plain', 'csv', 'json']),
+              default='plain')
+def query(store, devices, field, since, until, step, aggregate, format):
+    """
+    Query values of a local store
+
+    Shows the values of the given DEVICES (AINs or names, default: all)
+    collected with the --store option of export or fleet.
+    """
+    now = time.time()
+    store = TimeSeriesStore(store)
+    known = store.devices()
+    if devices:
+        by_name = dict((name, ain) for ain, name in known.items())
+        selected = [by_name.get(device, device) for device in devices]
+    else:
+        selected = sorted(known)
+    start = parse_time(since, now)
+    end = parse_time(until, now) if until else None
+    step = parse_duration(step) if step else None
+
+    rows = []
+    for ain in selected:
+        for timestamp, value in store.query(ain, field, start, end, step=step,
+                                            aggregate=aggregate):
+            rows.append((known.get(ain) or ain, ain, timestamp, value))
+
+    if format == 'json':
+        click.echo(json.dumps([
+            dict(zip(('name', 'ain', 'timestamp', field), row)) for row in rows
+        ]))
+    elif format == 'csv':
+        click.echo("name,ain,timestamp,{}".format(field))
+        for row in rows:
+            click.echo(",".join(str(column) for column in row))
+    else:
+        for name, ain, timestamp, value in rows:
+            click.echo("{} ({}) {} {}".format(
+                name, ain,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)),
+                value))
+
+
+@cli.command()
+@click.option('--listen', default='127.0.0.1')
+@click.option('--port', type=int, default=8080)
+@click.option('--devices', type=int, default=10,
+              help="Number of synthetic devices")
+@click.option('--latency', type=float, default=0.0,
+              help="Delay of every request in seconds")
+@click.option('--failure-rate', type=float, default=0.0,
+              help="Share of requests answered with HTTP 503")
+@click.option('--drop-rate', type=float, default=0.0,
+              help="Share of requests closed without answer")
+@click.option('--sid-ttl', type=int, default=600)
+@click.option('--seed', type=int, default=None)
+@click.pass_context
+def fakebox(context, listen, port, devices, latency, failure_rate, drop_rate,
+            sid_ttl, seed):
+    """
+    Run a fake FRITZ!Box for testing
+
+    Accepts the --username and --password given to the tool, e.g.
+    fritzhome fakebox --devices 500 in one shell and
+    fritzhome --host 127.0.0.1:8080 energy in another.
+    """
+    from .fakebox import FakeBox
+
+    fritz = context.obj
+    box = FakeBox(devices=devices, username=fritz.username, password=fritz.password,
+                  host=listen, port=port, latency=latency,
+                  failure_rate=failure_rate, drop_rate=drop_rate,
+                  sid_ttl=sid_ttl, seed=seed)
+    click.echo(" * Serving {} devices on {}".format(devices, box.url))
+    try:
+        box.serve_forever()
+    except KeyboardInterrupt:
+        box.stop()
+
+
+@cli.command()
+@click.option('--devices', default="10,100,1000",
+              help="Comma separated device counts")
+@click.option('--latency', type=float, default=0.0,
+              help="Delay of every request to the fake box in seconds")
+@click.option('--repeat', type=int, default=3)
+@click.option('--workers', type=int, default=3,
+              help="Parallel requests of the concurrent benchmark")
+@click.option('--only', multiple=True,
+              help="Run only this benchmark (can be repeated)")
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help="Store the results as JSON")
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False),
+              default=None, help="JSON results of an earlier run")
+def benchmark(devices, latency, repeat, workers, only, output, compare):
+    """
+    Benchmark the library against a fake FRITZ!Box
+
+    Does not talk to a real box, --host and the credentials are ignored.
+    """
+    from .benchmark import (
+        run_benchmarks, save_results, load_results, compare_results,
+    )
+
+    def progress(result):
+        memory = result['peak_memory']
+        click.echo("{:<14} {:>5} devices: {:>5} requests, {:9.2f} ms wall, "
+                   "{:9.2f} ms CPU, {} peak".format(
+                       result['benchmark'], result['devices'],
+                       result['requests'], result['wall_median'] * 1000,
+                       result['cpu_median'] * 1000,
+                       "{:.1f} KiB".format(memory / 1024) if memory is not None
+                       else "n/a"))
+
+    sizes = [int(size) for size in devices.split(',')]
+    results = run_benchmarks(sizes, latency=latency, repeat=repeat,
+                             workers=workers, names=only, progress=progress)
+    if output:
+        save_results(results, output)
+    if compare:
+        click.echo(" * Compared to {}".format(compare))
+        for name, size, old, new, ratio in compare_results(load_results(compare),
+                                                           results):
+            click.echo("{:<14} {:>5} devices: {:9.2f} ms -> {:9.2f} ms ({})".format(
+                name, size, old * 1000, new * 1000,
+                "{:.2f}x".format(ratio) if ratio is not None else "n/a"))
 
 
 @cli.command(name="switch-on")
@@ -219,17 +639,36 @@ def switch_toggle(context, ain):
 @cli.command()
 @click.option('--format', type=click.Choice(['plain', 'json']),
               default='plain')
+@click.option('--follow', is_flag=True, default=False,
+              help="Keep polling and show new entries (oldest first)")
+@click.option('--interval', type=int, default=60,
+              help="Seconds between polls with --follow")
+@click.option('--state', type=click.Path(dir_okay=False), default=None,
+              help="File remembering the shown entries with --follow")
+@click.option('--max-seen', type=int, default=10000,
+              help="Number of entries remembered with --follow")
 @click.pass_context
-def logs(context, format):
+def logs(context, format, follow, interval, state, max_seen):
     """Show system logs since last reboot"""
     fritz = context.obj
     fritz.login()
 
+    if follow:
+        seen = SeenHashes(max_seen, state)
+        try:
+            for msg in fritz.follow_logs(interval, seen):
+                if format == "json":
+                    click.echo(json.dumps(msg._asdict()))
+                else:
+                    click.echo(u"{} {} {}".format(msg.date, msg.time, msg.message))
+        except KeyboardInterrupt:
+            pass
+        return
+
     messages = fritz.get_logs()
     if format == "plain":
         for msg in messages:
-            merged = "{} {} {}".format(msg.date, msg.time, msg.message.encode("UTF-8"))
-            click.echo(merged)
+            click.echo(u"{} {} {}".format(msg.date, msg.time, msg.message))
 
     if format == "json":
         entries = [msg._asdict() for msg in messages]
@@ -3,10 +3,17 @@
     ~~~~~~~~~~~~~~~~~~~
 """
 
+import time
 import logging
+from collections import namedtuple
 logger = logging.getLogger(__name__)
 
 
+# Values of an actor at one point in time. Cheaper to create and to
+# keep around than Actor objects. Values are None if unknown.
+Reading = namedtuple("Reading", "ain timestamp power energy temperature state present")
+
+
 class Actor(object):
     """
     Represents a single SmartHome actor.
@@ -14,44 +21,87 @@ class Actor(object):
     instead.
     """
 
+    __slots__ = (
+        'box', 'actor_id', 'device_id', 'fwversion', 'productname',
+        'manufacturer', 'functionbitmask', 'name', 'has_powermeter',
+        'has_temperature', 'has_switch', 'has_heating_controller',
+        'present', 'state', 'power', 'energy', 'temperature',
+        'target_temperature', 'battery_low',
+    )
+
     def __init__(self, fritzbox, device):
         self.box = fritzbox
 
-        self.actor_id = device.attrib['identifier']
-        self.device_id = device.attrib['id']
-        self.name = device.find('name').text
-        self.fwversion = device.attrib['fwversion']
-        self.productname = device.attrib['productname']
-        self.manufacturer = device.attrib['manufacturer']
-        self.functionbitmask = int(device.attrib['functionbitmask'])
+        attrib = device.attrib
+        self.actor_id = attrib['identifier']
+        self.device_id = attrib['id']
+        self.fwversion = attrib['fwversion']
+        self.productname = attrib['productname']
+        self.manufacturer = attrib['manufacturer']
+        self.functionbitmask = int(attrib['functionbitmask'])
+
+        # Look up the child elements in a single pass
+        children = dict((child.tag, child) for child in device)
+        self.name = children['name'].text
 
         self.has_powermeter = self.functionbitmask & (1 << 7) > 0
         self.has_temperature = self.functionbitmask & (1 << 8) > 0
         self.has_switch = self.functionbitmask & (1 << 9) > 0
         self.has_heating_controller = self.functionbitmask & (1 << 6) > 0
 
+        # Readings contained in the device list itself. These are None
+        # if the firmware doesn't report them, use the get_* methods then.
+        self.present = self.__get_bool(children.get('present'))
+        self.state = None
+        if self.has_switch:
+            switch = children.get('switch')
+            if switch is not None:
+                self.state = self.__get_bool(switch.find('state'))
+
+        self.power = None
+        self.energy = None
+        if self.has_powermeter:
+            powermeter = children.get('powermeter')
+            if powermeter is not None:
+                self.power = self.__get_int(powermeter.find('power'))
+                self.energy = self.__get_int(powermeter.find('energy'))
+
         self.temperature = 0.0
         if self.has_temperature:
-            if device.find("temperature").find("celsius").text is not None:
-                self.temperature = int(device.find("temperature").find("celsius").text) / 10
+            celsius = children['temperature'].find("celsius").text
+            if celsius is not None:
+                self.temperature = int(celsius) / 10
             else:
                 logger.info("Actor " + self.name + " seems offline. Returning None as temperature.")
                 self.temperature = None
 
-        self.target_temperature = 0.0
         self.target_temperature = 0.0
         self.battery_low = True
         if self.has_heating_controller:
-            hkr = device.find("hkr")
+            hkr = children.get("hkr")
             if hkr is not None:
                 for child in hkr:
                     if child.tag == 'tist':
-                        self.temperature = self.__get_temp(child.text)
+                        self.temperature = parse_hkr_temperature(child.text)
                     elif child.tag == 'tsoll':
-                        self.target_temperature = self.__get_temp(child.text)
+                        self.target_temperature = parse_hkr_temperature(child.text)
                     elif child.tag == 'batterylow':
                         self.battery_low = (child.text == '1')
 
+    def as_reading(self, timestamp=None):
+        """
+        Return the values parsed from the device list as Reading.
+        """
+        return Reading(
+            self.actor_id,
+            timestamp if timestamp is not None else time.time(),
+            self.power,
+            self.energy,
+            self.temperature if self.has_temperature else None,
+            self.state,
+            self.present,
+        )
+
     def switch_on(self):
         """
         Set the power switch to ON.
@@ -68,16 +118,16 @@ class Actor(object):
         """
         Get the current switch state.
         """
-        return bool(
-            int(self.box.homeautoswitch("getswitchstate", self.actor_id))
+        return parse_switch_bool(
+            self.box.homeautoswitch("getswitchstate", self.actor_id)
         )
 
     def get_present(self):
         """
         Check if the registered actor is currently present (reachable).
         """
-        return bool(
-            int(self.box.homeautoswitch("getswitchpresent", self.actor_id))
+        return parse_switch_bool(
+            self.box.homeautoswitch("getswitchpresent", self.actor_id)
         )
 
     def get_power(self):
@@ -86,7 +136,7 @@ class Actor(object):
         Attention: Returns None if the value can't be queried or is unknown.
         """
         value = self.box.homeautoswitch("getswitchpower", self.actor_id)
-        return int(value) if value.isdigit() else None
+        return parse_switch_int(value)
 
     def get_energy(self):
         """
@@ -94,7 +144,7 @@ class Actor(object):
         Attention: Returns None if the value can't be queried or is unknown.
         """
         value = self.box.homeautoswitch("getswitchenergy", self.actor_id)
-        return int(value) if value.isdigit() else None
+        return parse_switch_int(value)
 
     def get_temperature(self):
         """
@@ -103,24 +153,19 @@ class Actor(object):
         """
         #raise NotImplementedError("This should work according to the AVM docs, but don't...")
         value = self.box.homeautoswitch("gettemperature", self.actor_id)
-        if value.isdigit():
-            self.temperature = float(value)/10
-        else:
-            self.temperature = None
+        self.temperature = parse_switch_temperature(value)
         return self.temperature
 
-    def __get_temp(self, value):
-        # Temperature is send from fritz.box a little weird
-        if value.isdigit():
-            value = float(value)
-            if value == 253:
-                return 0
-            elif value == 254:
-                return 30
-            else:
-                return value / 2
-        else:
+    def __get_int(self, element):
+        # Missing elements and empty values (offline actors) become None
+        if element is None or element.text is None:
             return None
+        value = element.text.strip()
+        return int(value) if value.isdigit() else None
+
+    def __get_bool(self, element):
+        value = self.__get_int(element)
+        return None if value is None else bool(value)
 
     def get_target_temperature(self):
         """
@@ -128,14 +173,17 @@ class Actor(object):
         Attention: Returns None if the value can't be queried or is unknown.
         """
         value = self.box.homeautoswitch("gethkrtsoll", self.actor_id)
-        self.target_temperature = self.__get_temp(value)
+        self.target_temperature = parse_hkr_temperature(value)
         return self.target_temperature
 
     def set_temperature(self, temp):
         """
         Sets the temperature in celcius
         """
+        param = self._temperature_param(temp)
+        return self.box.homeautoswitch("sethkrtsoll", self.actor_id, param)
 
+    def _temperature_param(self, temp):
         # Temperature is send to fritz.box a little weird
         param = 16 + ( ( temp - 8 ) * 2 )
         if param < 16:
@@ -146,8 +194,7 @@ class Actor(object):
             logger.info("Actor " + self.name + ": Temperature control set to on")
         else:
             logger.info("Actor " + self.name + ": Temperature control set to " + str(temp))
-
-        return self.box.homeautoswitch("sethkrtsoll", self.actor_id, param)
+        return param
 
     def get_consumption(self, timerange="10"):
         """
@@ -163,3 +210,37 @@ class Actor(object):
 
     def __repr__(self):
         return u"<Actor {}>".format(self.name)
+
+
+#
+# Conversion of homeautoswitch.lua answers, shared with AsyncActor
+#
+
+def parse_switch_int(value):
+    """Return a numeric switch answer as int or None if it's unknown"""
+    return int(value) if value.isdigit() else None
+
+
+def parse_switch_bool(value):
+    """Return a 0/1 switch answer as bool"""
+    return bool(int(value))
+
+
+def parse_switch_temperature(value):
+    """Return a temperature in tenths of a degree as celsius or None"""
+    return float(value) / 10 if value.isdigit() else None
+
+
+def parse_hkr_temperature(value):
+    """Return a HKR temperature in celsius or None"""
+    # Temperature is send from fritz.box a little weird
+    if value.isdigit():
+        value = float(value)
+        if value == 253:
+            return 0
+        elif value == 254:
+            return 30
+        else:
+            return value / 2
+    else:
+        return None
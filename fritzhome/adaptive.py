@@ -0,0 +1,200 @@
+"""
+    Adaptive polling
+    ~~~~~~~~~~~~~~~~
+
+    Queries the values of every actor with its own interval: actors
+    whose power or temperature doesn't change are polled less and less
+    often, while actors that change or were just switched are polled at
+    the shortest interval. All polls share one request budget, so the
+    box is never asked more than `budget` requests per second.
+"""
+
+import time
+import math
+import logging
+from collections import deque
+
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class ActorSchedule(object):
+    """
+    Polling state of a single actor.
+    """
+
+    __slots__ = ('ain', 'fields', 'interval', 'next_poll', 'history',
+                 'last', 'polls')
+
+    def __init__(self, ain, fields, interval, window):
+        self.ain = ain
+        self.fields = fields
+        self.interval = interval
+        self.next_poll = 0
+        self.history = deque(maxlen=window)
+        self.last = {}
+        self.polls = 0
+
+
+class AdaptivePoller(object):
+    """
+    Polls actors of a FritzBox with adaptive intervals.
+
+    After every poll of an actor, its interval is
+    - reset to `min_interval` if the switch state changed or power or
+      temperature moved more than the deadbands since the last poll,
+    - multiplied by `backoff` up to `max_interval` if the values of the
+      last `window` polls stayed within the deadbands.
+
+    Due actors are polled most overdue first, as long as the token
+    bucket of `budget` requests per second allows it. The others are
+    deferred to the next call of poll(), so an actor with many fields
+    isn't overtaken by later ones needing fewer requests.
+    """
+
+    def __init__(self, box, actors, min_interval=5, max_interval=300,
+                 budget=2.0, burst=None, window=5, backoff=1.5,
+                 power_deadband=1000, temperature_deadband=0.5,
+                 clock=time.time):
+        self.box = box
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.backoff = backoff
+        self.power_deadband = power_deadband
+        self.temperature_deadband = temperature_deadband
+        self.clock = clock
+
+        self.schedules = []
+        for actor in actors:
+            fields = []
+            if actor.has_powermeter:
+                fields.extend(('power', 'energy'))
+            if actor.has_switch:
+                fields.append('state')
+            if actor.has_temperature:
+                fields.append('temperature')
+            if fields:
+                self.schedules.append(ActorSchedule(
+                    actor.actor_id, tuple(fields), min_interval, window
+                ))
+
+        # The bucket must hold the requests of the largest actor,
+        # otherwise it would never be polled
+        largest = max([len(schedule.fields) for schedule in self.schedules] or [1])
+        self.bucket = TokenBucket(
+            budget, max(burst or budget * min_interval, largest), clock=clock
+        )
+
+        self.started = None
+        self.requests = 0
+        self.polls = 0
+        self.deferred = 0
+        self.errors = 0
+
+    def poll(self):
+        """
+        Poll all due actors the budget allows.
+
+        :return: dict of AIN to dict of field to value for the actors
+                 polled. Fields which couldn't be queried are missing.
+        """
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+
+        due = sorted(
+            (schedule for schedule in self.schedules if schedule.next_poll <= now),
+            key=lambda schedule: schedule.next_poll
+        )
+        selected = []
+        for schedule in due:
+            if not self.bucket.try_acquire(len(schedule.fields)):
+                break
+            selected.append(schedule)
+        self.deferred += len(due) - len(selected)
+        if not selected:
+            return {}
+
+        # Query actors with the same fields as one batch
+        batches = {}
+        for schedule in selected:
+            batches.setdefault(schedule.fields, []).append(schedule.ain)
+        results = {}
+        for fields, ains in batches.items():
+            results.update(self.box.query_actors(ains, fields))
+            self.requests += len(fields) * len(ains)
+
+        values = {}
+        for schedule in selected:
+            current = {}
+            for field, result in results[schedule.ain].items():
+                if result.error is not None:
+                    self.errors += 1
+                    logger.info("Polling %s of %s failed: %s", field,
+                                schedule.ain, result.error)
+                elif result.value is not None:
+                    current[field] = result.value
+            self._adapt(schedule, current, now)
+            values[schedule.ain] = current
+        self.polls += len(selected)
+        return values
+
+    def _adapt(self, schedule, current, now):
+        changed = False
+        last = schedule.last
+        if 'state' in current and 'state' in last and \
+                current['state'] != last['state']:
+            changed = True
+        for field, deadband in (('power', self.power_deadband),
+                                ('temperature', self.temperature_deadband)):
+            if field in current and field in last and \
+                    abs(current[field] - last[field]) > deadband:
+                changed = True
+
+        schedule.history.append(current)
+        schedule.last = current
+        schedule.polls += 1
+        if changed:
+            schedule.interval = self.min_interval
+        elif len(schedule.history) == schedule.history.maxlen and \
+                self._is_quiet(schedule.history):
+            schedule.interval = min(schedule.interval * self.backoff,
+                                    self.max_interval)
+        schedule.next_poll = now + schedule.interval
+
+    def _is_quiet(self, history):
+        # Standard deviation of power and temperature within the deadbands
+        for field, deadband in (('power', self.power_deadband),
+                                ('temperature', self.temperature_deadband)):
+            values = [entry[field] for entry in history if field in entry]
+            if len(values) < 2:
+                continue
+            mean = sum(values) / float(len(values))
+            variance = sum((value - mean) ** 2 for value in values) / len(values)
+            if math.sqrt(variance) > deadband:
+                return False
+        return True
+
+    def stats(self):
+        """
+        Return counters about the spent request budget and the current
+        polling intervals.
+        """
+        elapsed = 0
+        if self.started is not None:
+            elapsed = self.clock() - self.started
+        intervals = sorted(schedule.interval for schedule in self.schedules)
+        return {
+            'actors': len(self.schedules),
+            'polls': self.polls,
+            'requests': self.requests,
+            'errors': self.errors,
+            'deferred': self.deferred,
+            'requests_per_second': self.requests / elapsed if elapsed else 0.0,
+            'budget_used': self.requests / (self.budget * elapsed) if elapsed else 0.0,
+            'min_interval': intervals[0] if intervals else None,
+            'max_interval': intervals[-1] if intervals else None,
+            'median_interval': intervals[len(intervals) // 2] if intervals else None,
+        }
@@ -0,0 +1,359 @@
+"""
+    AVM Fritz!BOX SmartHome Client for asyncio
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Mirrors the FritzBox and Actor API with coroutines.
+    Requires Python 3.5+ and aiohttp (pip install fritzhome[async]).
+
+    Usage::
+
+        async with AsyncFritzBox(host, username, password) as fritz:
+            for actor in await fritz.get_actors():
+                print(actor.name, await actor.get_power())
+"""
+
+import json
+import time
+import asyncio
+
+import aiohttp
+
+from .actor import (
+    Actor, parse_switch_int, parse_switch_bool, parse_switch_temperature,
+    parse_hkr_temperature,
+)
+from .fritz import (
+    SID_INVALID, SID_REFRESH_MARGIN, calculate_response, parse_session_info,
+    login_failed, is_sid_rejected, homeautoswitch_params, parse_actors,
+    parse_devices, check_timerange, parse_consumption, parse_reset_result,
+    parse_logs, sanitize_ain,
+)
+from .session import SessionCache
+
+
+class AsyncFritzBox(object):
+    """
+    asyncio version of FritzBox.
+
+    All requests share one aiohttp connection pool, limited to
+    `connections` parallel connections to the box.
+    SIDs are handled like in FritzBox: they are requested on demand,
+    refreshed before they expire and replaced once if the box rejects
+    them. Concurrent tasks share a single re-login.
+    """
+
+    def __init__(self, ip, username, password, use_tls=False, sid_ttl=600,
+                 session_cache=None, connections=4):
+        if use_tls:
+            self.base_url = 'https://' + ip
+        else:
+            self.base_url = 'http://' + ip
+        self.username = username
+        self.password = password
+        self.sid = None
+        self.sid_ttl = sid_ttl
+        self._sid_expires = 0
+        self._login_lock = None
+
+        if session_cache is not None and \
+                not isinstance(session_cache, SessionCache):
+            session_cache = SessionCache(session_cache)
+        self.session_cache = session_cache
+
+        self.connections = connections
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the connection pool"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_session(self):
+        # aiohttp sessions must be created inside the running loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+            )
+        return self.session
+
+    def _get_login_lock(self):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        return self._login_lock
+
+    async def _get(self, path, params=None, timeout=10):
+        session = self._get_session()
+        async with session.get(self.base_url + path, params=params,
+                               timeout=aiohttp.ClientTimeout(total=timeout)) \
+                as response:
+            return await response.text()
+
+    async def login(self):
+        """
+        Try to login and set the internal session id.
+        See FritzBox.login.
+        """
+        async with self._get_login_lock():
+            return await self._login()
+
+    async def _login(self):
+        cached_sid = None
+        if self.session_cache is not None:
+            cached_sid = self.session_cache.get(self.base_url, self.username)
+
+        params = {"sid": cached_sid} if cached_sid else None
+        text = await self._get('/login_sid.lua', params=params)
+        sid, challenge, _ = parse_session_info(text)
+        if sid == SID_INVALID:
+            text = await self._get('/login_sid.lua', params={
+                "username": self.username,
+                "response": calculate_response(challenge, self.password),
+            })
+            sid, _, blocktime = parse_session_info(text)
+            if sid == SID_INVALID:
+                raise login_failed(blocktime)
+        self.sid = sid
+        self._sid_expires = time.time() + self.sid_ttl
+        if self.session_cache is not None and sid != cached_sid:
+            self.session_cache.set(self.base_url, self.username, sid)
+        return sid
+
+    #
+    # Useful public methods
+    #
+
+    async def get_actors(self):
+        """
+        Returns a list of AsyncActor objects for querying SmartHome devices.
+        """
+        devices = await self.homeautoswitch("getdevicelistinfos")
+        return parse_actors(self, devices, actor_class=AsyncActor)
+
+    async def get_actor_by_ain(self, ain):
+        """
+        Return a actor identified by it's ain or return None
+        """
+        ain = sanitize_ain(ain)
+        for actor in await self.get_actors():
+            if sanitize_ain(actor.actor_id) == ain:
+                return actor
+
+    #
+    # "Private" methods
+    #
+
+    async def get_sid(self):
+        """
+        Return a valid SID, logging in if required.
+        """
+        async with self._get_login_lock():
+            if self.sid is None or \
+                    time.time() >= self._sid_expires - SID_REFRESH_MARGIN:
+                await self._login()
+            return self.sid
+
+    async def relogin(self, stale_sid):
+        """
+        Replace a SID rejected by the box, unless another task already
+        did so.
+        """
+        async with self._get_login_lock():
+            if self.sid == stale_sid:
+                self.sid = None
+                await self._login()
+            return self.sid
+
+    async def request(self, method, path, params=None, data=None, timeout=10,
+                      **kwargs):
+        """
+        Send an authenticated request to the box and return the
+        response body.
+        Should only be used by internal library functions.
+        """
+        sid = await self.get_sid()
+        session = self._get_session()
+        url = self.base_url + path
+        for attempt in range(2):
+            if data is not None:
+                data = dict(data, sid=sid)
+            else:
+                params = dict(params or {}, sid=sid)
+            async with session.request(
+                    method, url, params=params, data=data,
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                    **kwargs) as response:
+                text = await response.text()
+                if attempt == 0 and is_sid_rejected(response.status, text):
+                    sid = await self.relogin(sid)
+                    continue
+                response.raise_for_status()
+                break
+        self._sid_expires = time.time() + self.sid_ttl
+        return text
+
+    async def homeautoswitch(self, cmd, ain=None, param=None):
+        """
+        Call a switch method.
+        Should only be used by internal library functions.
+        """
+        text = await self.request('GET', '/webservices/homeautoswitch.lua',
+                                  params=homeautoswitch_params(cmd, ain, param))
+        return text.strip().encode('utf-8')
+
+    async def set_switch_on(self, ain):
+        """Switch the power of a actor ON"""
+        return await self.homeautoswitch('setswitchon', ain)
+
+    async def set_switch_off(self, ain):
+        """Switch the power of a actor OFF"""
+        return await self.homeautoswitch('setswitchoff', ain)
+
+    async def set_switch_toggle(self, ain):
+        """Toggle a power switch and return the new state"""
+        return await self.homeautoswitch('setswitchtoggle', ain)
+
+    #
+    # DeviceID based methods
+    #
+
+    async def get_devices(self):
+        """
+        Return a list of devices.
+        Deprecated, use get_actors instead.
+        """
+        text = await self.request('GET', '/net/home_auto_query.lua', params={
+            'command': 'AllOutletStates',
+            'xhr': 0,
+        }, timeout=15)
+        return parse_devices(json.loads(text))
+
+    async def get_consumption(self, deviceid, timerange="10"):
+        """
+        Return all available energy consumption data for the device.
+        See FritzBox.get_consumption.
+        """
+        check_timerange(timerange)
+        text = await self.request('GET', '/net/home_auto_query.lua', params={
+            'command': 'EnergyStats_{0}'.format(timerange),
+            'id': deviceid,
+            'xhr': 0,
+        }, timeout=15)
+        return parse_consumption(json.loads(text))
+
+    async def reset_consumption(self, deviceid):
+        """
+        Resets the energy data stored on fritzbox for reports.
+        See FritzBox.reset_consumption.
+        """
+        text = await self.request('POST', '/net/home_auto_query.lua', data={
+            'command': 'ResetEnergyData',
+            'id': deviceid,
+            'xhr': 0,
+        }, timeout=15)
+        return parse_reset_result(text)
+
+    async def get_logs(self):
+        """
+        Return the system logs since the last reboot.
+        """
+        text = await self.request('GET', '/system/syslog.lua', params={
+            'stylemode': 'print',
+        }, timeout=15)
+        return parse_logs(text)
+
+
+class AsyncActor(Actor):
+    """
+    Actor returned by AsyncFritzBox, all queries are coroutines.
+    The attributes parsed from the device list are the same as in Actor.
+    """
+
+    __slots__ = ()
+
+    async def switch_on(self):
+        """
+        Set the power switch to ON.
+        """
+        return await self.box.set_switch_on(self.actor_id)
+
+    async def switch_off(self):
+        """
+        Set the power switch to OFF.
+        """
+        return await self.box.set_switch_off(self.actor_id)
+
+    async def get_state(self):
+        """
+        Get the current switch state.
+        """
+        return parse_switch_bool(
+            await self.box.homeautoswitch("getswitchstate", self.actor_id)
+        )
+
+    async def get_present(self):
+        """
+        Check if the registered actor is currently present (reachable).
+        """
+        return parse_switch_bool(
+            await self.box.homeautoswitch("getswitchpresent", self.actor_id)
+        )
+
+    async def get_power(self):
+        """
+        Returns the current power usage in milliWatts or None.
+        """
+        value = await self.box.homeautoswitch("getswitchpower", self.actor_id)
+        return parse_switch_int(value)
+
+    async def get_energy(self):
+        """
+        Returns the consumed energy since the start of the statistics
+        in Wh or None.
+        """
+        value = await self.box.homeautoswitch("getswitchenergy", self.actor_id)
+        return parse_switch_int(value)
+
+    async def get_temperature(self):
+        """
+        Returns the current environment temperature or None.
+        """
+        value = await self.box.homeautoswitch("gettemperature", self.actor_id)
+        self.temperature = parse_switch_temperature(value)
+        return self.temperature
+
+    async def get_target_temperature(self):
+        """
+        Returns the actual target temperature or None.
+        """
+        value = await self.box.homeautoswitch("gethkrtsoll", self.actor_id)
+        self.target_temperature = parse_hkr_temperature(value)
+        return self.target_temperature
+
+    async def set_temperature(self, temp):
+        """
+        Sets the temperature in celcius
+        """
+        param = self._temperature_param(temp)
+        return await self.box.homeautoswitch("sethkrtsoll", self.actor_id, param)
+
+    async def get_consumption(self, timerange="10"):
+        """
+        Return the energy report for the device.
+        """
+        return await self.box.get_consumption(self.device_id, timerange)
+
+    async def reset_consumption(self):
+        """
+        Resets the energy data stored on fritzbox for reports.
+        """
+        return await self.box.reset_consumption(self.device_id)
+
+    def __repr__(self):
+        return u"<AsyncActor {}>".format(self.name)
@@ -0,0 +1,250 @@
+"""
+    Benchmarks
+    ~~~~~~~~~~
+
+    Measures how the typical operations scale with the number of
+    devices and the latency of the box, using a FakeBox running in a
+    separate process (so its work doesn't count as client CPU time or
+    memory).
+
+    For every benchmark and device count the number of HTTP requests,
+    wall and CPU time and the peak memory allocated (Python 3 only) are
+    recorded. Results are plain dicts and can be stored as JSON for
+    comparing releases::
+
+        results = run_benchmarks(sizes=(10, 100), latency=0.01)
+        save_results(results, "benchmark.json")
+"""
+
+from __future__ import division
+
+import gc
+import json
+import time
+import platform
+import multiprocessing
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from .fritz import FritzBox, parse_actors, homeautoswitch_params
+from .fakebox import FakeBox, fake_logs, syslog_page
+from .logs import parse_log_page, parse_log_page_bs4
+from .exporters import metric_name, reading_metrics
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+def bench_parse(fritz, actors, devicelist, workers):
+    """Parse a downloaded device list into actors"""
+    parse_actors(fritz, devicelist)
+
+
+def bench_snapshot(fritz, actors, devicelist, workers):
+    """Download and parse the device list"""
+    fritz.get_actors()
+
+
+def bench_per_actor(fritz, actors, devicelist, workers):
+    """Query power and energy of every actor one after another"""
+    for actor in actors:
+        if actor.has_powermeter:
+            actor.get_power()
+            actor.get_energy()
+
+
+def bench_concurrent(fritz, actors, devicelist, workers):
+    """Query power and energy of every actor in parallel"""
+    fritz.query_actors([actor.actor_id for actor in actors
+                        if actor.has_powermeter],
+                       fields=('power', 'energy'), max_workers=workers)
+
+
+def bench_consumption(fritz, actors, devicelist, workers):
+    """Fetch the 24h energy statistics of the first device"""
+    fritz.get_consumption(actors[0].device_id, "24h")
+
+
+def bench_graphite_tick(fritz, actors, devicelist, workers):
+    """One snapshot tick of the graphite command, up to the carbon lines"""
+    now = int(time.time())
+    lines = []
+    for actor in fritz.get_actors():
+        key = "smarthome.{}".format(metric_name(actor.name))
+        for metric, value in reading_metrics(key, actor.as_reading(now)):
+            lines.append("{} {} {}".format(metric, value, now))
+    return lines
+
+
+def bench_syslog(fritz, actors, devicelist, workers):
+    """Download and parse the system log (10 entries per device)"""
+    fritz.get_logs()
+
+
+_log_pages = {}
+
+
+def log_page(entries):
+    """Return a synthetic syslog.lua print page with `entries` rows"""
+    if entries not in _log_pages:
+        _log_pages[entries] = syslog_page(fake_logs(entries))
+    return _log_pages[entries]
+
+
+def bench_log_parse(fritz, actors, devicelist, workers):
+    """Parse a syslog page with 100 entries per device"""
+    parse_log_page(log_page(len(actors) * 100))
+
+
+def bench_log_parse_bs4(fritz, actors, devicelist, workers):
+    """Parse the same syslog page with BeautifulSoup (skipped without bs4)"""
+    parse_log_page_bs4(log_page(len(actors) * 100))
+
+
+BENCHMARKS = [
+    ('parse', bench_parse),
+    ('snapshot', bench_snapshot),
+    ('per_actor', bench_per_actor),
+    ('concurrent', bench_concurrent),
+    ('consumption', bench_consumption),
+    ('graphite_tick', bench_graphite_tick),
+    ('syslog', bench_syslog),
+    ('log_parse', bench_log_parse),
+    ('log_parse_bs4', bench_log_parse_bs4),
+]
+
+
+def _serve(queue, devices, latency):
+    box = FakeBox(devices=devices, latency=latency, log_entries=devices * 10,
+                  seed=0)
+    queue.put(box.host)
+    box.serve_forever()
+
+
+def measure(function, fritz, repeat):
+    """
+    Run a function `repeat` times and return its requests, wall and
+    CPU time, plus the peak memory of one additional traced run.
+    """
+    walls = []
+    cpus = []
+    requests = 0
+    for _ in range(repeat):
+        gc.collect()
+        before = fritz.transport_stats()['requests']
+        wall = time.time()
+        cpu = process_time()
+        function()
+        cpus.append(process_time() - cpu)
+        walls.append(time.time() - wall)
+        requests = fritz.transport_stats()['requests'] - before
+
+    peak_memory = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    walls.sort()
+    cpus.sort()
+    return {
+        'requests': requests,
+        'wall_min': walls[0],
+        'wall_median': walls[len(walls) // 2],
+        'cpu_median': cpus[len(cpus) // 2],
+        'peak_memory': peak_memory,
+    }
+
+
+def run_benchmarks(sizes=(10, 100, 1000), latency=0.0, repeat=3, workers=3,
+                   names=None, progress=None):
+    """
+    Run the benchmarks (all or the ones in `names`) against fake boxes
+    with each of the device counts in `sizes`.
+
+    :param latency: seconds every request to the fake box is delayed
+    :param progress: called with each result as it is available
+    :return: dict with the environment and a list of results
+    """
+    results = []
+    for devices in sizes:
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(queue, devices, latency))
+        server.daemon = True
+        server.start()
+        try:
+            fritz = FritzBox(queue.get(timeout=30), "smarthome", "smarthome",
+                             max_workers=workers)
+            actors = fritz.get_actors()
+            devicelist = fritz.request(
+                'GET', '/webservices/homeautoswitch.lua',
+                params=homeautoswitch_params("getdevicelistinfos")
+            ).content
+
+            for name, benchmark in BENCHMARKS:
+                if names and name not in names:
+                    continue
+
+                def function():
+                    benchmark(fritz, actors, devicelist, workers)
+
+                try:
+                    function()  # warm up connections and caches
+                except ImportError:
+                    continue  # optional dependency not installed
+                result = measure(function, fritz, repeat)
+                result.update(benchmark=name, devices=devices)
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+        finally:
+            server.terminate()
+            server.join()
+
+    return {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': latency,
+        'repeat': repeat,
+        'workers': workers,
+        'results': results,
+    }
+
+
+def save_results(results, path):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def compare_results(old, new):
+    """
+    Return (benchmark, devices, old wall, new wall, ratio) for every
+    result present in both runs. A ratio above 1 means `new` is slower.
+    """
+    previous = dict(((result['benchmark'], result['devices']), result)
+                    for result in old['results'])
+    comparison = []
+    for result in new['results']:
+        key = (result['benchmark'], result['devices'])
+        if key not in previous:
+            continue
+        old_wall = previous[key]['wall_median']
+        new_wall = result['wall_median']
+        comparison.append(key + (old_wall, new_wall,
+                                 new_wall / old_wall if old_wall else None))
+    return comparison
@@ -0,0 +1,159 @@
+"""
+    Bulk consumption fetcher
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Fetches the energy statistics of many devices and time ranges in
+    parallel and writes every result to disk as soon as it arrives, one
+    JSON object per line::
+
+        fetcher = BulkFetcher(box, state_path="~/.fritzhome-bulk.json")
+        with open("consumption.jsonl", "a") as fp:
+            fetcher.run(device_ids, fp)
+
+    Ranges whose values can't have changed since the last fetch (e.g.
+    "year" within the same hour) are skipped, see REFETCH_INTERVALS.
+"""
+
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .fritz import TIMERANGES, check_timerange
+from .ratelimit import TokenBucket
+from .jsonfile import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which a range is fetched again
+REFETCH_INTERVALS = {
+    "10": 0,
+    "24h": 900,
+    "month": 3600,
+    "year": 3600,
+}
+
+
+class BulkFetcher(object):
+    """
+    Fetches get_consumption_series() of several devices and ranges with
+    `max_workers` parallel requests.
+
+    :param rate_limit: maximum requests per second, in addition to the
+                       rate limit of the box
+    :param state_path: JSON file remembering when each device and range
+                       was fetched, so repeated runs skip unchanged ranges
+    :param refetch_intervals: overrides REFETCH_INTERVALS
+    """
+
+    def __init__(self, box, timeranges=TIMERANGES, max_workers=4,
+                 rate_limit=None, state_path=None, refetch_intervals=None,
+                 clock=time.time):
+        for timerange in timeranges:
+            check_timerange(timerange)
+        self.box = box
+        self.timeranges = timeranges
+        self.max_workers = max_workers
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.state_path = os.path.expanduser(state_path) if state_path else None
+        self.refetch_intervals = dict(REFETCH_INTERVALS)
+        self.refetch_intervals.update(refetch_intervals or {})
+        self.clock = clock
+        self.last_fetch = self._read_state()
+
+    def key(self, deviceid, timerange):
+        return "{}/{}".format(deviceid, timerange)
+
+    def due(self, deviceids):
+        """Return the (device id, timerange) pairs which need to be fetched"""
+        now = self.clock()
+        jobs = []
+        for deviceid in deviceids:
+            for timerange in self.timeranges:
+                last = self.last_fetch.get(self.key(deviceid, timerange))
+                if last is None or now - last >= self.refetch_intervals[timerange]:
+                    jobs.append((deviceid, timerange))
+        return jobs
+
+    def iter_fetch(self, deviceids):
+        """
+        Fetch the due ranges and yield (device id, timerange, series,
+        error) in the order they complete. Either series or error is None.
+
+        At most twice `max_workers` requests are queued at a time, so
+        results don't pile up in memory if the consumer is slow.
+        """
+        jobs = iter(self.due(deviceids))
+        self.box.get_sid()
+        self.box.reserve_connections(self.max_workers)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            while True:
+                for deviceid, timerange in jobs:
+                    future = executor.submit(self._fetch, deviceid, timerange)
+                    pending[future] = (deviceid, timerange)
+                    if len(pending) >= self.max_workers * 2:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    deviceid, timerange = pending.pop(future)
+                    try:
+                        series = future.result()
+                    except Exception as error:
+                        logger.warning("Fetching %s of device %s failed: %s",
+                                       timerange, deviceid, error)
+                        yield deviceid, timerange, None, error
+                    else:
+                        self.last_fetch[self.key(deviceid, timerange)] = self.clock()
+                        yield deviceid, timerange, series, None
+
+    def _fetch(self, deviceid, timerange):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return self.box.get_consumption_series(deviceid, timerange)
+
+    def run(self, deviceids, fp):
+        """
+        Fetch the due ranges and write one JSON line per result to fp.
+        Failed fetches are written with an "error" and retried in the
+        next run.
+
+        :return: dict with the number of fetched, failed and skipped ranges
+        """
+        deviceids = list(deviceids)
+        counts = {'fetched': 0, 'failed': 0,
+                  'skipped': len(deviceids) * len(self.timeranges)}
+        try:
+            for deviceid, timerange, series, error in self.iter_fetch(deviceids):
+                counts['skipped'] -= 1
+                record = {'device_id': deviceid, 'timerange': timerange}
+                if error is not None:
+                    counts['failed'] += 1
+                    record['error'] = str(error)
+                else:
+                    counts['fetched'] += 1
+                    record.update(
+                        start=series.timestamps[0] if len(series.timestamps) else None,
+                        interval=series.interval,
+                        watts=list(series.watts),
+                        volts=list(series.volts),
+                    )
+                fp.write(json.dumps(record) + "\n")
+                fp.flush()
+        finally:
+            self._write_state()
+        return counts
+
+    def _read_state(self):
+        if self.state_path is None:
+            return {}
+        data = read_json(self.state_path, {}, "bulk state")
+        return data if isinstance(data, dict) else {}
+
+    def _write_state(self):
+        if self.state_path is None:
+            return
+        write_json(self.state_path, self.last_fetch)
@@ -0,0 +1,138 @@
+"""
+    Carbon client
+    ~~~~~~~~~~~~~
+
+    Sends metrics to carbon (graphite) in batches, using either the
+    plaintext (port 2003) or the pickle protocol (port 2004).
+    Metrics are spooled in memory while carbon is unreachable and sent
+    once the connection is back.
+"""
+
+import time
+import socket
+import struct
+import pickle
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PORTS = {
+    'plaintext': 2003,
+    'pickle': 2004,
+}
+
+
+class CarbonClient(object):
+    """
+    Buffering carbon client.
+
+    send() queues metrics and tries to flush them, sending up to
+    `batch_size` metrics per write. If the connection fails, the client
+    waits `min_backoff` seconds before reconnecting, doubling the wait
+    up to `max_backoff` on every failure. At most `spool_size` metrics
+    are kept meanwhile, the oldest ones are dropped first.
+    """
+
+    def __init__(self, host, port=None, protocol='plaintext', batch_size=500,
+                 spool_size=100000, timeout=2, min_backoff=1, max_backoff=60):
+        if protocol not in DEFAULT_PORTS:
+            raise ValueError("Unknown protocol. Possible values are: {0}".format(
+                tuple(DEFAULT_PORTS)
+            ))
+        self.host = host
+        self.port = port or DEFAULT_PORTS[protocol]
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.spool = deque(maxlen=spool_size)
+        self.dropped = 0
+        self._sock = None
+        self._backoff = 0
+        self._next_connect = 0
+
+    def connect(self):
+        """
+        Connect to carbon, unless the last attempt failed less than the
+        current backoff ago.
+
+        :return: True if connected
+        """
+        if self._sock is not None:
+            return True
+        if time.time() < self._next_connect:
+            return False
+        try:
+            self._sock = socket.create_connection((self.host, self.port),
+                                                  timeout=self.timeout)
+        except (socket.error, socket.timeout) as error:
+            self._failed(error)
+            return False
+        self._backoff = 0
+        return True
+
+    def close(self):
+        """Close the connection, spooled metrics are kept"""
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def _failed(self, error):
+        self.close()
+        self._backoff = min(max(self._backoff * 2, self.min_backoff),
+                            self.max_backoff)
+        self._next_connect = time.time() + self._backoff
+        logger.warning("Carbon %s:%s unavailable (%s), retrying in %ss, "
+                       "%s metrics spooled", self.host, self.port, error,
+                       self._backoff, len(self.spool))
+
+    def send(self, metrics):
+        """
+        Queue a list of (key, value, timestamp) tuples and flush.
+
+        :return: number of metrics sent
+        """
+        overflow = len(self.spool) + len(metrics) - self.spool.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+        self.spool.extend(metrics)
+        return self.flush()
+
+    def flush(self):
+        """
+        Send the spooled metrics in batches.
+
+        :return: number of metrics sent
+        """
+        sent = 0
+        while self.spool and self.connect():
+            batch = [self.spool[i]
+                     for i in range(min(self.batch_size, len(self.spool)))]
+            try:
+                self._sock.sendall(self.encode(batch))
+            except (socket.error, socket.timeout) as error:
+                self._failed(error)
+                break
+            for _ in batch:
+                self.spool.popleft()
+            sent += len(batch)
+        return sent
+
+    def encode(self, batch):
+        """Return the wire format of a list of metrics"""
+        if self.protocol == 'pickle':
+            payload = pickle.dumps([
+                (key, (timestamp, value)) for key, value, timestamp in batch
+            ], protocol=2)
+            return struct.pack("!L", len(payload)) + payload
+        return "".join(
+            "{} {} {}\n".format(key, value, timestamp)
+            for key, value, timestamp in batch
+        ).encode('utf-8')
@@ -0,0 +1,165 @@
+"""
+    Consumption history
+    ~~~~~~~~~~~~~~~~~~~
+
+    Array-backed energy statistics: the values of an EnergyStats_*
+    response as scaled, chronologically ordered arrays with timestamps,
+    and matrices of several devices (one row per device, one column per
+    point in time) for fleet wide aggregates.
+
+    Without NumPy the values are stored as array('d'). With NumPy
+    installed and use_numpy=True, they are numpy arrays and the
+    aggregates of ConsumptionMatrix are vectorized.
+"""
+
+from __future__ import division
+
+import time
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Seconds between two values if the box doesn't report EnStats_timer_type
+SAMPLE_INTERVALS = {
+    "10": 10,
+    "24h": 900,
+    "month": 86400,
+    "year": 2629800,
+}
+
+ConsumptionSeries = namedtuple(
+    "ConsumptionSeries", "device_id timerange interval timestamps watts volts"
+)
+
+_value_keys = {}
+
+
+def value_keys(count):
+    """Return the (cached) watt and volt keys of a response with count values"""
+    keys = _value_keys.get(count)
+    if keys is None:
+        keys = _value_keys[count] = (
+            ["EnStats_watt_value_{}".format(i) for i in range(1, count + 1)],
+            ["EnStats_volt_value_{}".format(i) for i in range(1, count + 1)],
+        )
+    return keys
+
+
+def check_numpy(use_numpy):
+    if use_numpy and numpy is None:
+        raise RuntimeError("Please install numpy to use use_numpy=True")
+
+
+def parse_consumption_series(device_id, timerange, data, now=None,
+                             use_numpy=False):
+    """
+    Parse a EnergyStats_* response into a ConsumptionSeries.
+
+    The box lists the newest value first; the series is ordered oldest
+    first. Watts and volts are scaled (the box sends 1/100 W and mV).
+    The newest value is timestamped `now` (default: the current time),
+    the others EnStats_timer_type seconds apart.
+    """
+    check_numpy(use_numpy)
+    if now is None:
+        now = time.time()
+    count = int(data["EnStats_count"])
+    interval = int(data.get("EnStats_timer_type") or 0) or SAMPLE_INTERVALS[timerange]
+    watt_keys, volt_keys = value_keys(count)
+    watts = [int(data[key]) for key in reversed(watt_keys)]
+    volts = [int(data[key]) for key in reversed(volt_keys)]
+    start = now - (count - 1) * interval
+
+    if use_numpy:
+        timestamps = start + numpy.arange(count, dtype=float) * interval
+        return ConsumptionSeries(device_id, timerange, interval, timestamps,
+                                 numpy.array(watts, dtype=float) / 100,
+                                 numpy.array(volts, dtype=float) / 1000)
+    return ConsumptionSeries(
+        device_id, timerange, interval,
+        array('d', [start + i * interval for i in range(count)]),
+        array('d', [watt / 100 for watt in watts]),
+        array('d', [volt / 1000 for volt in volts]),
+    )
+
+
+class ConsumptionMatrix(object):
+    """
+    Power values of several devices over the same time range.
+
+    `watts` has one row per device of `device_ids` and one column per
+    timestamp. Missing values (failed requests, devices with a shorter
+    history) are NaN. `errors` maps device ids whose history couldn't
+    be fetched to the exception.
+    """
+
+    def __init__(self, series, timerange, errors=None, use_numpy=False):
+        check_numpy(use_numpy)
+        self.timerange = timerange
+        self.errors = errors or {}
+        self.use_numpy = use_numpy
+        self.device_ids = [entry.device_id for entry in series] + list(self.errors)
+
+        longest = max(series, key=lambda entry: len(entry.watts)) if series else None
+        self.interval = longest.interval if longest else SAMPLE_INTERVALS[timerange]
+        self.timestamps = longest.timestamps if longest else array('d')
+        width = len(self.timestamps)
+
+        # Align the newest values, pad older ones with NaN
+        nan = float('nan')
+        rows = [[nan] * (width - len(entry.watts)) + list(entry.watts)
+                for entry in series]
+        rows.extend([nan] * width for _ in self.errors)
+        if use_numpy:
+            self.watts = numpy.array(rows, dtype=float).reshape(len(rows), width)
+        else:
+            self.watts = [array('d', row) for row in rows]
+
+    def _columns(self):
+        # Values of every timestamp without NaN (pure Python fallback)
+        for column in zip(*self.watts):
+            yield [value for value in column if value == value]
+
+    def total(self):
+        """Summed power of all devices per timestamp"""
+        if self.use_numpy:
+            return numpy.nansum(self.watts, axis=0)
+        return array('d', [sum(column) for column in self._columns()])
+
+    def peak(self):
+        """Highest power of any device per timestamp"""
+        if self.use_numpy:
+            return numpy.nanmax(self.watts, axis=0)
+        return array('d', [max(column) if column else float('nan')
+                           for column in self._columns()])
+
+    def percentile(self, q):
+        """The q-th percentile (0-100) of the device powers per timestamp"""
+        if self.use_numpy:
+            return numpy.nanpercentile(self.watts, q, axis=0)
+        values = array('d')
+        for column in self._columns():
+            if not column:
+                values.append(float('nan'))
+                continue
+            column.sort()
+            # Linear interpolation like numpy.percentile
+            rank = (len(column) - 1) * q / 100
+            lower = int(rank)
+            upper = min(lower + 1, len(column) - 1)
+            values.append(column[lower] + (column[upper] - column[lower]) *
+                          (rank - lower))
+        return values
+
+    def energy(self):
+        """Consumed energy per device in Wh over the whole range"""
+        if self.use_numpy:
+            return numpy.nansum(self.watts, axis=1) * self.interval / 3600
+        return array('d', [
+            sum(value for value in row if value == value) * self.interval / 3600
+            for row in self.watts
+        ])
@@ -0,0 +1,97 @@
+"""
+    Change detection
+    ~~~~~~~~~~~~~~~~
+
+    Most values of a smart home hardly ever change: switched off actors
+    report 0 W, energy counters stand still and temperatures move by a
+    tenth of a degree now and then. DeltaFilter sits between polling and
+    output and drops the values which didn't change since they were
+    last emitted, while still repeating every value at least once per
+    heartbeat interval so the series don't go stale.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reading fields passed through the filter
+FIELDS = ('power', 'energy', 'temperature', 'state', 'present')
+
+
+class DeltaFilter(object):
+    """
+    Emits the fields of a Reading only when they changed.
+
+    A value is emitted if
+    - it differs by more than the field's deadband (default 0, i.e. any
+      change) from the value last emitted for the actor,
+    - it wasn't emitted for `heartbeat` seconds (None disables it),
+    - the energy counter went backwards, which happens after
+      reset_consumption() or a reboot of the actor. The reset is counted
+      and the new counter value becomes the reference.
+
+    Comparing with the last emitted value (not the last polled one)
+    makes slow drifts show up once they exceed the deadband.
+    """
+
+    def __init__(self, deadbands=None, heartbeat=300):
+        self.deadbands = dict((field, 0) for field in FIELDS)
+        self.deadbands.update(deadbands or {})
+        self.heartbeat = heartbeat
+        # (ain, field) -> (value, timestamp) of the last emission
+        self.last = {}
+        self.seen = 0
+        self.emitted = 0
+        self.resets = 0
+
+    def filter(self, reading):
+        """
+        Return the reading with all fields that don't need to be emitted
+        set to None.
+        """
+        hidden = {}
+        for field in FIELDS:
+            value = getattr(reading, field)
+            if value is None:
+                continue
+            self.seen += 1
+            key = (reading.ain, field)
+            last = self.last.get(key)
+            if last is None or self._changed(reading.ain, field, value, last[0]) or \
+                    (self.heartbeat is not None and
+                     reading.timestamp - last[1] >= self.heartbeat):
+                self.last[key] = (value, reading.timestamp)
+                self.emitted += 1
+            else:
+                hidden[field] = None
+        return reading._replace(**hidden) if hidden else reading
+
+    def _changed(self, ain, field, value, last):
+        if field == 'energy' and value < last:
+            self.resets += 1
+            logger.info("Energy counter of %s was reset (%s -> %s)",
+                        ain, last, value)
+            return True
+        if isinstance(value, bool) or isinstance(last, bool):
+            return value != last
+        return abs(value - last) > self.deadbands.get(field, 0)
+
+    def forget(self, ain=None):
+        """
+        Drop the last values of an actor (or all), so its next values
+        are emitted in any case.
+        """
+        if ain is None:
+            self.last.clear()
+        else:
+            for field in FIELDS:
+                self.last.pop((ain, field), None)
+
+    def stats(self):
+        """Return the number of values seen, emitted and suppressed"""
+        return {
+            'seen': self.seen,
+            'emitted': self.emitted,
+            'suppressed': self.seen - self.emitted,
+            'resets': self.resets,
+        }
@@ -0,0 +1,443 @@
+"""
+    Metrics exporters
+    ~~~~~~~~~~~~~~~~~
+
+    Exporters receive the actors of one device list poll and pass their
+    values on to a monitoring system. All exporters share the same
+    interface, so one polling loop can feed several of them::
+
+        exporters = [PrometheusExporter(9167), StatsdExporter('localhost')]
+        for actors in ...:
+            for exporter in exporters:
+                exporter.export(box_name, timestamp, actors)
+
+    The signature of export() matches the output of FleetPoller.
+    The request instrumentation of a box (FritzBox.stats()) can be
+    exported as well with export_stats().
+"""
+
+import re
+import socket
+import logging
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from requests import Session
+
+logger = logging.getLogger(__name__)
+
+simple_chars = re.compile('[^A-Za-z0-9]+')
+
+# Metric names of the Reading fields
+READING_METRICS = (
+    ('current', 'power'),
+    ('total', 'energy'),
+    ('temperature', 'temperature'),
+    ('state', 'state'),
+    ('present', 'present'),
+)
+
+
+def reading_metrics(key, reading):
+    """Return the known values of a reading as key-value-pairs"""
+    metrics = []
+    for metric, field in READING_METRICS:
+        value = getattr(reading, field)
+        if value is not None:
+            if isinstance(value, bool):
+                value = int(value)
+            metrics.append(("{}.{}".format(key, metric), value))
+    return metrics
+
+
+def request_metrics(stats):
+    """Return the counters of FritzBox.stats() as (command, metric, value)"""
+    metrics = []
+    for command in sorted(stats['commands']):
+        values = stats['commands'][command]
+        metrics.extend([
+            (command, 'requests', values['requests']),
+            (command, 'errors', values['errors']),
+            (command, 'bytes', values['bytes']),
+            (command, 'network_seconds', values['network']['sum']),
+            (command, 'parse_seconds', values['parse']['sum']),
+        ])
+    return metrics
+
+
+def metric_name(name):
+    """Replace all characters not allowed in graphite/statsd keys"""
+    return simple_chars.sub('_', name)
+
+
+class Exporter(object):
+    """
+    Base class of all exporters.
+    """
+
+    def export(self, box, timestamp, actors):
+        """
+        Export the values of a device list.
+
+        :param box: name of the box the actors belong to
+        :param timestamp: unix timestamp of the poll
+        :param actors: list of Actor objects
+        """
+        raise NotImplementedError()
+
+    def export_stats(self, box, timestamp, stats):
+        """
+        Export the request instrumentation of a box.
+
+        :param stats: result of FritzBox.stats()
+        """
+
+    def close(self):
+        """Release all resources"""
+
+
+class CarbonExporter(Exporter):
+    """
+    Sends the values to carbon using a CarbonClient.
+    Keys are <prefix>.[<box>.]<actor name>.<metric>.
+    """
+
+    def __init__(self, client, prefix="smarthome", include_box=False):
+        self.client = client
+        self.prefix = prefix
+        self.include_box = include_box
+
+    def export(self, box, timestamp, actors):
+        timestamp = int(timestamp)
+        metrics = []
+        for actor in actors:
+            parts = [self.prefix, metric_name(actor.name)]
+            if self.include_box:
+                parts.insert(1, metric_name(box))
+            key = ".".join(parts)
+            metrics.extend(
+                (metric, value, timestamp)
+                for metric, value in reading_metrics(key, actor.as_reading(timestamp))
+            )
+        self.client.send(metrics)
+
+    def export_stats(self, box, timestamp, stats):
+        timestamp = int(timestamp)
+        key = stats_key(self.prefix, box, self.include_box)
+        self.client.send([
+            ("{}.{}.{}".format(key, metric_name(command), metric), value, timestamp)
+            for command, metric, value in request_metrics(stats)
+        ])
+
+    def close(self):
+        self.client.close()
+
+
+class StatsdExporter(Exporter):
+    """
+    Sends the values as StatsD gauges over UDP.
+    Several gauges are combined into one packet up to `max_packet` bytes.
+    """
+
+    def __init__(self, host, port=8125, prefix="smarthome", include_box=False,
+                 max_packet=512):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.include_box = include_box
+        self.max_packet = max_packet
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self, box, timestamp, actors):
+        lines = []
+        for actor in actors:
+            parts = [self.prefix, metric_name(actor.name)]
+            if self.include_box:
+                parts.insert(1, metric_name(box))
+            key = ".".join(parts)
+            for metric, value in reading_metrics(key, actor.as_reading(timestamp)):
+                lines.append("{}:{}|g".format(metric, value).encode('utf-8'))
+        self._send_lines(lines)
+
+    def export_stats(self, box, timestamp, stats):
+        key = stats_key(self.prefix, box, self.include_box)
+        self._send_lines([
+            "{}.{}.{}:{}|g".format(key, metric_name(command), metric,
+                                   value).encode('utf-8')
+            for command, metric, value in request_metrics(stats)
+        ])
+
+    def _send_lines(self, lines):
+        packet = b""
+        for line in lines:
+            if packet and len(packet) + len(line) + 1 > self.max_packet:
+                self._send(packet)
+                packet = b""
+            packet = packet + b"\n" + line if packet else line
+        if packet:
+            self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self.sock.sendto(packet, self.address)
+        except socket.error as error:
+            logger.warning("Sending to statsd %s:%s failed: %s",
+                           self.address[0], self.address[1], error)
+
+    def close(self):
+        self.sock.close()
+
+
+class InfluxExporter(Exporter):
+    """
+    Writes the values in the InfluxDB line protocol, one point per actor
+    and poll, e.g. to http://localhost:8086/write?db=smarthome
+
+    Points are buffered and written once `batch_size` points are
+    collected or `flush_interval` seconds passed since the last write.
+    If a write fails, at most `max_buffer` points are kept for the next
+    attempt.
+    """
+
+    def __init__(self, url, measurement="fritzhome", batch_size=500,
+                 flush_interval=10, max_buffer=100000, timeout=10):
+        self.url = url
+        self.measurement = measurement
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.buffer = []
+        self.session = Session()
+        self._last_flush = None
+
+    def export(self, box, timestamp, actors):
+        for actor in actors:
+            line = self.format_point(box, actor, timestamp)
+            if line is not None:
+                self.buffer.append(line)
+        if self._last_flush is None:
+            self._last_flush = timestamp
+        if len(self.buffer) >= self.batch_size or \
+                timestamp - self._last_flush >= self.flush_interval:
+            self.flush()
+            self._last_flush = timestamp
+
+    def export_stats(self, box, timestamp, stats):
+        values = {}
+        for command, metric, value in request_metrics(stats):
+            values.setdefault(command, []).append(
+                "{}={}".format(metric, value) if isinstance(value, float)
+                else "{}={}i".format(metric, value))
+        for command in sorted(values):
+            self.buffer.append("{}_requests,box={},command={} {} {}".format(
+                self.measurement, escape_influx(box), escape_influx(command),
+                ",".join(values[command]), int(timestamp) * 10 ** 9))
+
+    def format_point(self, box, actor, timestamp):
+        """Return the line protocol of an actor or None without values"""
+        reading = actor.as_reading(timestamp)
+        fields = []
+        for field in ('power', 'energy', 'temperature', 'state', 'present'):
+            value = getattr(reading, field)
+            if value is None:
+                continue
+            if isinstance(value, float):
+                fields.append("{}={}".format(field, value))
+            else:
+                fields.append("{}={}i".format(field, int(value)))
+        if not fields:
+            return None
+        tags = ",".join("{}={}".format(key, escape_influx(value)) for key, value in (
+            ('box', box),
+            ('ain', actor.actor_id),
+            ('name', actor.name),
+        ))
+        return "{},{} {} {}".format(self.measurement, tags, ",".join(fields),
+                                    int(timestamp) * 10 ** 9)
+
+    def flush(self):
+        """Write all buffered points"""
+        if not self.buffer:
+            return
+        lines = self.buffer
+        self.buffer = []
+        try:
+            response = self.session.post(self.url, timeout=self.timeout,
+                                         data="\n".join(lines).encode('utf-8'))
+            response.raise_for_status()
+        except Exception as error:
+            logger.warning("Writing %s points to InfluxDB failed: %s",
+                           len(lines), error)
+            self.buffer = (lines + self.buffer)[-self.max_buffer:]
+
+    def close(self):
+        self.flush()
+        self.session.close()
+
+
+class PrometheusExporter(Exporter):
+    """
+    Serves the values of the last poll on http://<host>:<port>/metrics.
+    Scrapes only read the cached snapshot and never query a box.
+    """
+
+    METRICS = (
+        ('power', 'fritzhome_power_watts', "Current power consumption", 0.001),
+        ('energy', 'fritzhome_energy_watthours_total', "Consumed energy", 1),
+        ('temperature', 'fritzhome_temperature_celsius', "Temperature", 1),
+        ('state', 'fritzhome_switch_state', "Switch state (1 = on)", 1),
+        ('present', 'fritzhome_present', "Actor reachable (1 = yes)", 1),
+    )
+
+    def __init__(self, port=9167, host=''):
+        self.snapshots = {}
+        self.request_stats = {}
+        self.body = b""
+        self._lock = threading.Lock()
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.body
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="prometheus-exporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def export(self, box, timestamp, actors):
+        readings = [(actor.name, actor.as_reading(timestamp)) for actor in actors]
+        with self._lock:
+            self.snapshots[box] = (timestamp, readings)
+            self.body = self.render().encode('utf-8')
+
+    def export_stats(self, box, timestamp, stats):
+        with self._lock:
+            self.request_stats[box] = stats
+            self.body = self.render().encode('utf-8')
+
+    def render(self):
+        """Return the exposition format of all snapshots"""
+        lines = []
+        for field, name, help_text, factor in self.METRICS:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(
+                name, 'counter' if name.endswith('_total') else 'gauge'))
+            for box in sorted(self.snapshots):
+                for actor_name, reading in self.snapshots[box][1]:
+                    value = getattr(reading, field)
+                    if value is None:
+                        continue
+                    lines.append('{}{{box="{}",ain="{}",name="{}"}} {}'.format(
+                        name, escape_label(box), escape_label(reading.ain),
+                        escape_label(actor_name), float(value) * factor
+                    ))
+        name = 'fritzhome_last_poll_timestamp_seconds'
+        lines.append("# HELP {} Time of the last device list poll".format(name))
+        lines.append("# TYPE {} gauge".format(name))
+        for box in sorted(self.snapshots):
+            lines.append('{}{{box="{}"}} {}'.format(
+                name, escape_label(box), self.snapshots[box][0]
+            ))
+        if self.request_stats:
+            lines.extend(self.render_request_stats())
+        return "\n".join(lines) + "\n"
+
+    def render_request_stats(self):
+        """Return the exposition format of the request instrumentation"""
+        lines = []
+        for field, name, help_text in (
+                ('requests', 'fritzhome_requests_total', "Requests sent to the box"),
+                ('errors', 'fritzhome_request_errors_total', "Failed requests"),
+                ('bytes', 'fritzhome_response_bytes_total', "Bytes received"),
+        ):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} counter".format(name))
+            for box in sorted(self.request_stats):
+                commands = self.request_stats[box]['commands']
+                for command in sorted(commands):
+                    lines.append('{}{{box="{}",command="{}"}} {}'.format(
+                        name, escape_label(box), escape_label(command),
+                        commands[command][field]
+                    ))
+
+        for field, name, help_text in (
+                ('network', 'fritzhome_request_duration_seconds',
+                 "Time until the response was read"),
+                ('parse', 'fritzhome_parse_duration_seconds',
+                 "Time spent parsing responses"),
+        ):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} histogram".format(name))
+            for box in sorted(self.request_stats):
+                commands = self.request_stats[box]['commands']
+                for command in sorted(commands):
+                    histogram = commands[command][field]
+                    labels = 'box="{}",command="{}"'.format(
+                        escape_label(box), escape_label(command))
+                    cumulative = 0
+                    for bound, count in zip(histogram['buckets'] + ['+Inf'],
+                                            histogram['counts']):
+                        cumulative += count
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                            name, labels, bound, cumulative))
+                    lines.append('{}_sum{{{}}} {}'.format(name, labels,
+                                                         histogram['sum']))
+                    lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                                           histogram['count']))
+        return lines
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StoreExporter(Exporter):
+    """
+    Appends the values to a local TimeSeriesStore.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def export(self, box, timestamp, actors):
+        self.store.append(
+            [actor.as_reading(timestamp) for actor in actors],
+            names=dict((actor.actor_id, actor.name) for actor in actors)
+        )
+
+
+def stats_key(prefix, box, include_box):
+    """Return the carbon/StatsD key prefix of request metrics"""
+    parts = [prefix, 'requests']
+    if include_box:
+        parts.insert(1, metric_name(box))
+    return ".".join(parts)
+
+
+def escape_label(value):
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def escape_influx(value):
+    """Escape an InfluxDB tag value"""
+    for char in ('\\', ',', '=', ' '):
+        value = value.replace(char, '\\' + char)
+    return value
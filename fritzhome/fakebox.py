@@ -0,0 +1,445 @@
+"""
+    Fake FRITZ!Box
+    ~~~~~~~~~~~~~~
+
+    A local HTTP server imitating the parts of the FRITZ!Box web
+    interface used by this library, for testing and benchmarking
+    without real hardware::
+
+        with FakeBox(devices=500, latency=0.2) as box:
+            fritz = FritzBox(box.host, box.username, box.password)
+            fritz.get_actors()
+
+    Implemented: challenge-response login with SID expiry and BlockTime
+    after failed logins, homeautoswitch.lua (switch, power, energy,
+    temperature and HKR commands, getdevicelistinfos),
+    home_auto_query.lua (AllOutletStates, EnergyStats_*,
+    ResetEnergyData) and the syslog.lua print page.
+
+    Every request can be delayed (`latency`) and fail with HTTP 503
+    (`failure_rate`) or a dropped connection (`drop_rate`).
+"""
+
+from __future__ import division
+
+import sys
+import json
+import time
+import random
+import socket
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+from .fritz import SID_INVALID, TIMERANGES, calculate_response, sanitize_ain
+
+
+# Number of values and seconds per value of the EnergyStats ranges
+ENERGY_STATS = {
+    "10": (60, 10),
+    "24h": (96, 900),
+    "month": (31, 86400),
+    "year": (12, 2678400),
+}
+
+LOG_MESSAGES = [
+    "Event {}: Smart Home device {} reconnected.",
+    u"Event {}: Anmeldung an der FRITZ!Box-Benutzeroberfl\u00e4che von "
+    u"Smart Home device {} & IP-Adresse 192.168.178.20.",
+    "Event {}: Smart Home device {} <DECT> lost connection.",
+]
+
+SWITCH_BITMASK = (1 << 11) | (1 << 9) | (1 << 8) | (1 << 7)
+HKR_BITMASK = (1 << 8) | (1 << 6)
+
+
+class FakeDevice(object):
+    """
+    State of a synthetic smart home device.
+    Every tenth device is a radiator controller (HKR), the others are
+    switchable outlets with power meter.
+    """
+
+    def __init__(self, index, rng):
+        self.index = index
+        self.ain = "08761 {:07d}".format(index + 1)
+        self.device_id = 16 + index
+        self.is_hkr = index % 10 == 9
+        self.name = "{} {}".format("Heizung" if self.is_hkr else "Steckdose", index + 1)
+        self.functionbitmask = HKR_BITMASK if self.is_hkr else SWITCH_BITMASK
+        self.productname = "FRITZ!DECT 301" if self.is_hkr else "FRITZ!DECT 200"
+        self.present = True
+        self.state = rng.random() < 0.5
+        self.base_power = rng.choice((0, 0, 0, 1500, 45000, 120000))
+        self.energy = rng.randint(0, 500000)
+        self.temperature = rng.randint(180, 240)   # 0.1 degrees
+        self.tsoll = rng.randint(32, 46)           # 0.5 degrees
+        self.battery_low = False
+
+    def power(self):
+        """Current power in mW, fluctuating around the base power"""
+        if not self.state or not self.present:
+            return 0
+        return int(self.base_power * random.uniform(0.95, 1.05))
+
+    def to_xml(self):
+        """Return the <device> element of getdevicelistinfos"""
+        parts = [
+            '<device identifier="{}" id="{}" functionbitmask="{}" '
+            'fwversion="04.16" manufacturer="AVM" productname="{}">'.format(
+                self.ain, self.device_id, self.functionbitmask, self.productname),
+            '<present>{}</present>'.format(int(self.present)),
+            '<name>{}</name>'.format(escape(self.name)),
+        ]
+        if not self.is_hkr:
+            parts.append('<switch><state>{}</state><mode>manuell</mode>'
+                         '<lock>0</lock><devicelock>0</devicelock></switch>'
+                         .format(int(self.state) if self.present else ''))
+            parts.append('<powermeter><power>{}</power><energy>{}</energy>'
+                         '</powermeter>'.format(
+                             self.power() if self.present else '',
+                             self.energy if self.present else ''))
+        parts.append('<temperature><celsius>{}</celsius><offset>0</offset>'
+                     '</temperature>'.format(
+                         self.temperature if self.present else ''))
+        if self.is_hkr:
+            parts.append('<hkr><tist>{}</tist><tsoll>{}</tsoll><absenk>32</absenk>'
+                         '<komfort>42</komfort><batterylow>{}</batterylow></hkr>'
+                         .format(self.temperature // 5, self.tsoll,
+                                 int(self.battery_low)))
+        parts.append('</device>')
+        return "".join(parts)
+
+
+def fake_logs(count, devices=10, rng=random):
+    """Return `count` (date, time, message) syslog entries, oldest first"""
+    return [
+        ("17.10.26", "{:02d}:{:02d}:{:02d}".format(
+            (index // 3600) % 24, (index // 60) % 60, index % 60),
+         LOG_MESSAGES[index % len(LOG_MESSAGES)].format(
+             index, rng.randint(1, max(devices, 1))))
+        for index in range(count)
+    ]
+
+
+def syslog_page(logs):
+    """Return the syslog.lua print page of (date, time, message) entries"""
+    rows = "".join(
+        '<tr><td class="c1">{}</td><td class="c2">{}</td>'
+        '<td class="c3"><a href="#">{}</a></td></tr>\n'.format(
+            date, log_time, escape(message))
+        for date, log_time, message in reversed(logs)
+    )
+    return (
+        '<!DOCTYPE html><html><head><title>FRITZ!Box</title></head><body>'
+        '<table id="log">\n{}</table></body></html>'.format(rows)
+    )
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on a slow answer aren't errors of the box
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeBox(object):
+    """
+    Fake FRITZ!Box serving `devices` synthetic devices.
+
+    :param port: 0 picks a free port, see `host` and `url`
+    :param latency: seconds every request is delayed
+    :param failure_rate: share of requests answered with HTTP 503
+    :param drop_rate: share of requests closed without answer
+    :param sid_ttl: seconds of inactivity after which a SID expires
+    :param log_entries: number of syslog entries
+    """
+
+    def __init__(self, devices=10, username="smarthome", password="smarthome",
+                 host="127.0.0.1", port=0, latency=0.0, failure_rate=0.0,
+                 drop_rate=0.0, sid_ttl=600, log_entries=100, seed=None):
+        rng = random.Random(seed)
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.sid_ttl = sid_ttl
+
+        self.devices = [FakeDevice(index, rng) for index in range(devices)]
+        self.by_ain = dict((sanitize_ain(device.ain), device)
+                           for device in self.devices)
+        self.by_id = dict((str(device.device_id), device)
+                          for device in self.devices)
+        self.logs = fake_logs(log_entries, devices, rng)
+
+        self.sids = {}
+        self.challenge = None
+        self.failed_logins = 0
+        self.blocked_until = 0
+        self.requests = {}
+        self.lock = threading.RLock()
+
+        self.server = _ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def host(self):
+        """host:port to pass to FritzBox"""
+        return "{}:{}".format(*self.server.server_address[:2])
+
+    @property
+    def url(self):
+        return "http://" + self.host
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="fakebox")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve requests in the current thread"""
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    #
+    # Session handling
+    #
+
+    def check_sid(self, sid):
+        """Check a SID and extend its lifetime"""
+        now = time.time()
+        with self.lock:
+            last_used = self.sids.get(sid)
+            if last_used is None or now - last_used > self.sid_ttl:
+                self.sids.pop(sid, None)
+                return False
+            self.sids[sid] = now
+            return True
+
+    def login(self, params):
+        """Return the SessionInfo XML for a login_sid.lua request"""
+        sid = params.get('sid')
+        if sid and self.check_sid(sid):
+            return self.session_info(sid)
+
+        if 'response' in params:
+            with self.lock:
+                blocked = time.time() < self.blocked_until
+                expected = self.challenge and calculate_response(
+                    self.challenge, self.password)
+                if not blocked and params.get('username') == self.username \
+                        and params['response'] == expected:
+                    sid = "{:016x}".format(random.getrandbits(64))
+                    self.sids[sid] = time.time()
+                    self.failed_logins = 0
+                    return self.session_info(sid)
+                if not blocked:
+                    # Failed logins invalidate all sessions and block
+                    # further attempts for an increasing time
+                    self.sids.clear()
+                    self.failed_logins += 1
+                    self.blocked_until = time.time() + \
+                        2 ** min(self.failed_logins - 1, 8)
+        return self.session_info(SID_INVALID)
+
+    def session_info(self, sid):
+        with self.lock:
+            self.challenge = "{:08x}".format(random.getrandbits(32))
+            blocktime = max(0, int(round(self.blocked_until - time.time())))
+            return (
+                '<?xml version="1.0" encoding="utf-8"?><SessionInfo>'
+                '<SID>{}</SID><Challenge>{}</Challenge><BlockTime>{}</BlockTime>'
+                '<Rights></Rights></SessionInfo>'.format(
+                    sid, self.challenge, blocktime)
+            )
+
+    #
+    # AHA interface
+    #
+
+    def homeautoswitch(self, params):
+        """Return (status, body) of a homeautoswitch.lua command"""
+        cmd = params.get('switchcmd', '')
+        if cmd == 'getswitchlist':
+            return 200, ",".join(sanitize_ain(device.ain) for device in self.devices
+                                 if not device.is_hkr) + "\n"
+        if cmd == 'getdevicelistinfos':
+            return 200, '<devicelist version="1">{}</devicelist>\n'.format(
+                "".join(device.to_xml() for device in self.devices))
+
+        device = self.by_ain.get(sanitize_ain(params.get('ain', '')))
+        if device is None:
+            return 400, "Bad Request"
+
+        with self.lock:
+            if cmd in ('setswitchon', 'setswitchoff', 'setswitchtoggle'):
+                if cmd == 'setswitchtoggle':
+                    device.state = not device.state
+                else:
+                    device.state = cmd == 'setswitchon'
+                return 200, "{}\n".format(int(device.state))
+            if cmd == 'sethkrtsoll':
+                device.tsoll = int(params.get('param', device.tsoll))
+                return 200, "{}\n".format(device.tsoll)
+
+        if not device.present and cmd not in ('getswitchpresent', 'getswitchname'):
+            return 200, "inval\n"
+        values = {
+            'getswitchstate': lambda: int(device.state),
+            'getswitchpresent': lambda: int(device.present),
+            'getswitchpower': device.power,
+            'getswitchenergy': lambda: device.energy,
+            'getswitchname': lambda: device.name,
+            'gettemperature': lambda: device.temperature,
+            'gethkrtsoll': lambda: device.tsoll,
+        }
+        if cmd not in values:
+            return 400, "Bad Request"
+        return 200, "{}\n".format(values[cmd]())
+
+    def home_auto_query(self, params):
+        """Return (status, body) of a home_auto_query.lua command"""
+        command = params.get('command', '')
+        if command == 'AllOutletStates':
+            data = {"Outlet_count": str(len(self.devices))}
+            for number, device in enumerate(self.devices, 1):
+                data["DeviceID_{}".format(number)] = str(device.device_id)
+                data["DeviceConnectState_{}".format(number)] = "2" if device.present else "0"
+                data["DeviceSwitchState_{}".format(number)] = str(int(device.state))
+            return 200, json.dumps(data)
+
+        device = self.by_id.get(params.get('id', ''))
+        if device is None:
+            return 400, "Bad Request"
+
+        if command == 'ResetEnergyData':
+            with self.lock:
+                device.energy = 0
+            return 200, json.dumps({"RequestResult": True})
+
+        timerange = command[len('EnergyStats_'):]
+        if not command.startswith('EnergyStats_') or timerange not in TIMERANGES:
+            return 400, "Bad Request"
+        count, timer_type = ENERGY_STATS[timerange]
+        rng = random.Random(device.device_id)
+        watts = [int(device.base_power / 10 * rng.uniform(0.8, 1.2))
+                 for _ in range(count)]
+        data = {
+            "MM_Value_Amp": str(device.power() // 230),
+            "MM_Value_Power": str(device.power() // 10),
+            "MM_Value_Volt": str(rng.randint(228000, 232000)),
+            "EnStats_average_value": str(sum(watts) // count),
+            "EnStats_max_value": str(max(watts)),
+            "EnStats_min_value": str(min(watts)),
+            "EnStats_timer_type": str(timer_type),
+            "EnStats_count": str(count),
+            "sum_Day": str(device.energy % 10000),
+            "sum_Month": str(device.energy % 100000),
+            "sum_Year": str(device.energy),
+            "RequestResult": True,
+        }
+        for number, watt in enumerate(watts, 1):
+            data["EnStats_watt_value_{}".format(number)] = str(watt)
+            data["EnStats_volt_value_{}".format(number)] = str(rng.randint(228000, 232000))
+        return 200, json.dumps(data)
+
+    def syslog(self):
+        """Return the syslog.lua print page"""
+        return syslog_page(self.logs)
+
+    #
+    # HTTP
+    #
+
+    def _handler(self):
+        box = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, avoid waiting
+            # for delayed ACKs on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                self.dispatch(url.path, parse_qs(url.query))
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                self.dispatch(url.path, parse_qs(body))
+
+            def dispatch(self, path, query):
+                params = dict((key, values[-1]) for key, values in query.items())
+                if box.latency:
+                    time.sleep(box.latency)
+                if box.drop_rate and random.random() < box.drop_rate:
+                    self.close_connection = True
+                    return
+                if box.failure_rate and random.random() < box.failure_rate:
+                    box.count('failed')
+                    return self.reply(503, "Service Unavailable")
+
+                if path == '/login_sid.lua':
+                    box.count('login')
+                    return self.reply(200, box.login(params), 'text/xml')
+
+                authorized = box.check_sid(params.get('sid', ''))
+                if path == '/webservices/homeautoswitch.lua':
+                    box.count(params.get('switchcmd', ''))
+                    if not authorized:
+                        return self.reply(403, "Forbidden")
+                    return self.reply(*box.homeautoswitch(params))
+                if path == '/net/home_auto_query.lua':
+                    box.count(params.get('command', ''))
+                    if not authorized:
+                        return self.reply(403, "Forbidden")
+                    return self.reply(*box.home_auto_query(params))
+                if path == '/system/syslog.lua':
+                    box.count('syslog')
+                    if not authorized:
+                        return self.reply(403, "Forbidden")
+                    return self.reply(200, box.syslog(), 'text/html')
+                self.reply(404, "Not Found")
+
+            def reply(self, status, body, content_type='text/plain'):
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type + '; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
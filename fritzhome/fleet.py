@@ -0,0 +1,141 @@
+"""
+    Fleet poller
+    ~~~~~~~~~~~~
+
+    Polls many FRITZ!Boxes from one process. Every box is polled by its
+    own thread, so a slow or locked out box never delays the others,
+    and all results are handed to a single output function.
+
+    The boxes are configured in an INI file, one section per box::
+
+        [home]
+        host = 192.168.178.1
+        username = smarthome
+        password = secret
+        # optional:
+        use_tls = no
+        interval = 10
+        timeout = 10
+        # maximum requests per second and burst, default: unlimited
+        rate_limit = 2
+        burst = 5
+"""
+
+import time
+import logging
+import threading
+from collections import namedtuple
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import SafeConfigParser as ConfigParser
+
+from .fritz import FritzBox
+
+logger = logging.getLogger(__name__)
+
+
+BoxConfig = namedtuple("BoxConfig", "name host username password use_tls interval "
+                                    "timeout rate_limit burst")
+
+
+def load_config(path):
+    """
+    Read the fleet configuration and return a list of BoxConfig.
+    """
+    parser = ConfigParser()
+    if not parser.read(path):
+        raise IOError("Can't read fleet configuration {}".format(path))
+
+    boxes = []
+    for name in parser.sections():
+        def option(key, default=None, getter=parser.get):
+            if parser.has_option(name, key):
+                return getter(name, key)
+            return default
+
+        boxes.append(BoxConfig(
+            name=name,
+            host=parser.get(name, 'host'),
+            username=option('username', 'smarthome'),
+            password=option('password', 'smarthome'),
+            use_tls=option('use_tls', False, parser.getboolean),
+            interval=option('interval', 10, parser.getfloat),
+            timeout=option('timeout', 10, parser.getfloat),
+            rate_limit=option('rate_limit', None, parser.getfloat),
+            burst=option('burst', None, parser.getfloat),
+        ))
+    return boxes
+
+
+class FleetPoller(object):
+    """
+    Polls the device lists of several boxes concurrently.
+
+    `output` is called from the thread running run() with the box name,
+    the poll timestamp and the list of actors for every successful poll.
+    Each box is polled at most every `interval` seconds; after a failed
+    login, the box isn't polled again until its BlockTime has passed.
+    """
+
+    def __init__(self, boxes, output, queue_size=1000):
+        self.boxes = boxes
+        self.output = output
+        self.queue = Queue(queue_size)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def poll_box(self, config):
+        """
+        Poll a single box until stop() is called.
+        """
+        fritz = FritzBox(config.host, config.username, config.password,
+                         use_tls=config.use_tls, timeout=config.timeout,
+                         rate_limit=config.rate_limit, burst=config.burst)
+        next_poll = time.time()
+        while not self._stop.is_set():
+            try:
+                actors = fritz.get_actors()
+            except Exception as error:
+                blocktime = getattr(error, 'blocktime', 0)
+                logger.warning("Polling %s failed: %s", config.name, error)
+                next_poll = time.time() + max(blocktime, config.interval)
+            else:
+                self.queue.put((config.name, int(time.time()), actors))
+                # Skip missed polls instead of catching up
+                next_poll = max(next_poll + config.interval, time.time())
+            self._stop.wait(max(0, next_poll - time.time()))
+
+    def start(self):
+        """Start one polling thread per box"""
+        for config in self.boxes:
+            thread = threading.Thread(target=self.poll_box, args=(config, ),
+                                      name="fleet-{}".format(config.name))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop polling, run() returns afterwards"""
+        self._stop.set()
+
+    def run(self):
+        """
+        Start polling and pass all results to the output until stop()
+        is called.
+        """
+        if not self._threads:
+            self.start()
+        while not self._stop.is_set():
+            try:
+                name, timestamp, actors = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                self.output(name, timestamp, actors)
+            except Exception:
+                logger.exception("Output failed for %s", name)
@@ -12,21 +12,49 @@
 from __future__ import print_function, division
 
 import re
+import json
+import time
 import hashlib
+import logging
+import threading
+from io import BytesIO
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from xml.etree import ElementTree as ET
 
-from requests import Session
-try:
-    from bs4 import BeautifulSoup
-except ImportError:
-    BeautifulSoup = None
+from .actor import (
+    Actor, parse_switch_int, parse_switch_bool, parse_switch_temperature,
+)
+from .session import SessionCache
+from .ratelimit import TokenBucket
+from .transport import Transport
+from .instrumentation import RequestStats, TimedReader
+from .consumption import (
+    ConsumptionMatrix, parse_consumption_series, value_keys,
+)
+from .logs import (
+    LogEntry, SeenHashes, parse_log_page, parse_log_page_bs4,
+)
 
-from .actor import Actor
+logger = logging.getLogger(__name__)
 
 
 Device = namedtuple("Device", "deviceid connectstate switchstate")
-LogEntry = namedtuple("LogEntry", "date time message hash")
+QueryResult = namedtuple("QueryResult", "value error")
+
+# Actor values which can be queried with query_actors
+ACTOR_QUERIES = {
+    'state': ("getswitchstate", parse_switch_bool),
+    'present': ("getswitchpresent", parse_switch_bool),
+    'power': ("getswitchpower", parse_switch_int),
+    'energy': ("getswitchenergy", parse_switch_int),
+    'temperature': ("gettemperature", parse_switch_temperature),
+}
+
+# SID returned by the box for anonymous/invalid sessions
+SID_INVALID = "0000000000000000"
+# Seconds before the expected SID expiry at which we log in again
+SID_REFRESH_MARGIN = 30
 
 
 class FritzBox(object):
@@ -35,12 +63,17 @@ class FritzBox(object):
     which are poorly documented by AVM...
 
     A note about SIDs:
-     They expire after some time. If you have a long-running daemon,
-     you should call login() every 10 minutes or so else you'll get
-     nice 403 errors.
+     They expire after some time (10 minutes without any request).
+     The client keeps track of the SID's age and logs in again shortly
+     before it expires. If the box rejects a SID anyway (403 or an
+     invalid SID in the response), a new one is requested once and the
+     request is retried. Concurrent threads share a single re-login.
     """
 
-    def __init__(self, ip, username, password, use_tls=False):
+    def __init__(self, ip, username, password, use_tls=False, sid_ttl=600,
+                 session_cache=None, timeout=None, max_workers=3,
+                 registry_ttl=300, cache_ttl=0, rate_limit=None, burst=None,
+                 connect_timeout=5, retries=2, backoff=0.5):
         if use_tls:
             self.base_url = 'https://' + ip
         else:
@@ -48,8 +81,48 @@ class FritzBox(object):
         self.username = username
         self.password = password
         self.sid = None
-
-        self.session = Session()
+        self.sid_ttl = sid_ttl
+        self._sid_expires = 0
+        self._login_lock = threading.RLock()
+
+        # Optional on-disk SID cache shared between processes
+        if session_cache is not None and \
+                not isinstance(session_cache, SessionCache):
+            session_cache = SessionCache(session_cache)
+        self.session_cache = session_cache
+
+        # Overrides the per-request default (read) timeouts if set,
+        # can also be a tuple of (connect timeout, read timeout)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        # Parallel requests of query_many/query_actors. The box's webserver
+        # doesn't cope well with more than a few.
+        self.max_workers = max_workers
+
+        # Actors of the last device list, see get_actor_by_ain
+        # and get_actors
+        self.registry_ttl = registry_ttl
+        self.cache_ttl = cache_ttl
+        self._registry = ActorRegistry()
+        # Incremented by invalidate_actors(), see iter_actors()
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        # Optional limit of requests per second, see request()
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = TokenBucket(rate_limit, burst)
+        # Read-only switch commands currently running, see homeautoswitch()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # Keep-alive pool for the parallel queries plus login/streaming
+        # (grown if more workers are used), idempotent requests are
+        # retried with jittered backoff
+        self.transport = Transport(pool_size=max_workers + 2, retries=retries,
+                                   backoff=backoff)
+        self.session = self.transport.session
+        # Latency histograms and counters, see stats()
+        self.instrumentation = RequestStats()
 
     def login(self):
         """
@@ -59,84 +132,380 @@ class FritzBox(object):
         - Any failed login resets all existing session ids, even of
           other users.
         - SIDs expire after some time
+
+        If a session cache is configured, a cached SID is validated
+        first and the challenge-response login is only done if the box
+        doesn't accept it anymore.
         """
-        response = self.session.get(self.base_url + '/login_sid.lua', timeout=10)
-        xml = ET.fromstring(response.text)
-        if xml.find('SID').text == "0000000000000000":
-            challenge = xml.find('Challenge').text
-            url = self.base_url + "/login_sid.lua"
-            response = self.session.get(url, params={
-                "username": self.username,
-                "response": self.calculate_response(challenge, self.password),
-            }, timeout=10)
-            xml = ET.fromstring(response.text)
-            sid = xml.find('SID').text
-            if xml.find('SID').text == "0000000000000000":
-                blocktime = int(xml.find('BlockTime').text)
-                exc = Exception("Login failed, please wait {} seconds".format(
-                    blocktime
-                ))
-                exc.blocktime = blocktime
-                raise exc
+        with self._login_lock:
+            cached_sid = None
+            if self.session_cache is not None:
+                cached_sid = self.session_cache.get(self.base_url, self.username)
+
+            start = time.time()
+            nbytes = 0
+            try:
+                # Returns the given SID if it's still valid
+                params = {"sid": cached_sid} if cached_sid else None
+                response = self.session.get(self.base_url + '/login_sid.lua',
+                                            params=params,
+                                            timeout=self.get_timeout(10))
+                nbytes += len(response.content)
+                sid, challenge, _ = parse_session_info(response.text)
+                if sid == SID_INVALID:
+                    url = self.base_url + "/login_sid.lua"
+                    # Not retried, a repeated response counts as failed login
+                    response = self.transport.once_session.get(url, params={
+                        "username": self.username,
+                        "response": self.calculate_response(challenge, self.password),
+                    }, timeout=self.get_timeout(10))
+                    nbytes += len(response.content)
+                    sid, _, blocktime = parse_session_info(response.text)
+                    if sid == SID_INVALID:
+                        raise login_failed(blocktime)
+            except Exception:
+                self.instrumentation.record('login', network=time.time() - start,
+                                            nbytes=nbytes, error=True)
+                raise
+            self.instrumentation.record('login', network=time.time() - start,
+                                        nbytes=nbytes)
             self.sid = sid
+            self._sid_expires = time.time() + self.sid_ttl
+            if self.session_cache is not None and sid != cached_sid:
+                self.session_cache.set(self.base_url, self.username, sid)
             return sid
 
     def calculate_response(self, challenge, password):
         """Calculate response for the challenge-response authentication"""
-        to_hash = (challenge + "-" + password).encode("UTF-16LE")
-        hashed = hashlib.md5(to_hash).hexdigest()
-        return "{0}-{1}".format(challenge, hashed)
+        return calculate_response(challenge, password)
 
     #
     # Useful public methods
     #
 
-    def get_actors(self):
+    def get_actors(self, max_age=None):
         """
         Returns a list of Actor objects for querying SmartHome devices.
 
         This is currently the only working method for getting temperature data.
+
+        :param max_age: Return the actors of the last device list if it
+                        isn't older than max_age seconds. Defaults to the
+                        cache_ttl of the box (0, always request it).
+                        Switching or setting temperatures invalidates it.
         """
-        devices = self.homeautoswitch("getdevicelistinfos")
-        xml = ET.fromstring(devices)
+        if max_age is None:
+            max_age = self.cache_ttl
+        registry = self._registry
+        if max_age > 0 and registry.fresh and registry.age() <= max_age:
+            return list(registry.actors)
 
-        actors = []
-        for device in xml.findall('device'):
-            actors.append(Actor(fritzbox=self, device=device))
+        return list(self.iter_actors())
 
-        return actors
+    def get_readings(self, max_age=None):
+        """
+        Returns the values of all actors from one device list as a list
+        of Reading, all with the same timestamp.
+        """
+        actors = self.get_actors(max_age=max_age)
+        timestamp = time.time()
+        return [actor.as_reading(timestamp) for actor in actors]
+
+    def iter_actors(self):
+        """
+        Yields the actors of the device list while it's downloaded and
+        parsed, without building the whole XML tree in memory.
+        The actor registry is updated once the generator is exhausted.
+        """
+        # A device changed during the download may be listed with its
+        # old values, so the list doesn't count as fresh then
+        generation = self._generation
+        start = time.time()
+        response = self.request('GET', '/webservices/homeautoswitch.lua',
+                                params=homeautoswitch_params("getdevicelistinfos"),
+                                stream=True)
+        network = time.time() - start
+        busy = 0.0
+        reader = TimedReader(response.raw)
+        try:
+            response.raw.decode_content = True
+            actors = []
+            parser = iter_parse_actors(self, reader)
+            while True:
+                # Time spent by the caller between actors isn't counted
+                start = time.time()
+                actor = next(parser, None)
+                busy += time.time() - start
+                if actor is None:
+                    break
+                actors.append(actor)
+                yield actor
+        except Exception:
+            self.instrumentation.record('getdevicelistinfos', error=True,
+                                        nbytes=reader.bytes)
+            raise
+        finally:
+            response.close()
+        self.instrumentation.record('getdevicelistinfos',
+                                    network=network + reader.seconds,
+                                    nbytes=reader.bytes)
+        self.instrumentation.record_parse('getdevicelistinfos',
+                                          busy - reader.seconds)
+        registry = ActorRegistry(actors)
+        registry.fresh = generation == self._generation
+        self._registry = registry
+
+    def invalidate_actors(self):
+        """
+        Mark the values of the cached device list, and of any device
+        list currently downloaded, as outdated.
+        The actors stay available for lookups by AIN, id or name.
+        """
+        with self._generation_lock:
+            self._generation += 1
+        self._registry.fresh = False
 
     def get_actor_by_ain(self, ain):
         """
         Return a actor identified by it's ain or return None
         """
-        for actor in self.get_actors():
-            if actor.actor_id == ain:
+        return self._lookup_actor('by_ain', sanitize_ain(ain))
+
+    def get_actor_by_device_id(self, device_id):
+        """
+        Return a actor identified by it's device id or return None
+        """
+        return self._lookup_actor('by_device_id', str(device_id))
+
+    def get_actor_by_name(self, name):
+        """
+        Return a actor identified by it's name or return None
+        """
+        return self._lookup_actor('by_name', name)
+
+    def _lookup_actor(self, index, key):
+        # Use the actors of the last device list, unless they are too
+        # old or the actor is missing (e.g. newly paired). Names and ids
+        # don't change by switching, so invalidated values don't matter.
+        registry = self._registry
+        if registry.age() <= self.registry_ttl:
+            actor = getattr(registry, index).get(key)
+            if actor is not None:
                 return actor
+        # Download the list even if cache_ttl allows an older one
+        self.get_actors(max_age=0)
+        return getattr(self._registry, index).get(key)
+
+    def query_many(self, cmd, ains, parse=None, max_workers=None):
+        """
+        Call a switch command for several AINs in parallel.
+
+        :param parse: optional function applied to each answer
+        :param max_workers: overrides the box's max_workers
+        :return: dict of AIN to QueryResult(value, error); if a request
+                 failed, value is None and error the exception.
+        """
+        return self._run_queries(
+            [(ain, cmd, ain, parse) for ain in ains],
+            max_workers
+        )
+
+    def query_actors(self, ains, fields=('power', 'energy'), max_workers=None):
+        """
+        Query several values (see ACTOR_QUERIES) of several actors
+        in parallel.
+
+        :return: dict of AIN to a dict of field name to QueryResult
+        """
+        jobs = []
+        for ain in ains:
+            for field in fields:
+                cmd, parse = ACTOR_QUERIES[field]
+                jobs.append(((ain, field), cmd, ain, parse))
+        results = {}
+        for (ain, field), result in self._run_queries(jobs, max_workers).items():
+            results.setdefault(ain, {})[field] = result
+        return results
 
     #
     # "Private" methods
     #
 
+    def _run_queries(self, jobs, max_workers=None):
+        # jobs are tuples of (key, cmd, ain, parse)
+        def run(cmd, ain, parse):
+            try:
+                value = self.homeautoswitch(cmd, ain)
+                return QueryResult(parse(value) if parse else value, None)
+            except Exception as error:
+                return QueryResult(None, error)
+
+        if not jobs:
+            return {}
+        # Log in once up front instead of in every worker
+        self.get_sid()
+        workers = max(1, min(max_workers or self.max_workers, len(jobs)))
+        self.reserve_connections(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (key, executor.submit(run, cmd, ain, parse))
+                for key, cmd, ain, parse in jobs
+            ]
+            results = {}
+            for key, future in futures:
+                results[key] = future.result()
+        return results
+
+    def reserve_connections(self, workers):
+        """
+        Make sure the connection pool keeps enough connections open for
+        `workers` parallel requests (plus login and streaming).
+        """
+        self.transport.ensure_pool_size(workers + 2)
+
+    def get_sid(self):
+        """
+        Return a valid SID, logging in if there is none yet or if the
+        current one is about to expire.
+        """
+        with self._login_lock:
+            if self.sid is None or \
+                    time.time() >= self._sid_expires - SID_REFRESH_MARGIN:
+                self.login()
+            return self.sid
+
+    def relogin(self, stale_sid):
+        """
+        Replace a SID rejected by the box.
+        If another thread already replaced it, its new SID is used
+        instead of logging in again.
+        """
+        with self._login_lock:
+            if self.sid == stale_sid:
+                self.instrumentation.record_relogin()
+                self.sid = None
+                self.login()
+            return self.sid
+
+    def get_timeout(self, read_timeout):
+        """
+        Return the (connect, read) timeout tuple for a request.
+        """
+        timeout = self.timeout if self.timeout is not None else read_timeout
+        if isinstance(timeout, tuple):
+            return timeout
+        return (min(self.connect_timeout, timeout), timeout)
+
+    def transport_stats(self):
+        """
+        Return counters of the HTTP transport: requests, opened
+        connections, requests on reused keep-alive connections and
+        retries.
+        """
+        return self.transport.stats()
+
+    def stats(self):
+        """
+        Return the request instrumentation: per command the number of
+        requests, errors and bytes received plus histograms of network
+        and parse time, network time histograms per AIN, the number of
+        re-logins and the transport_stats().
+        """
+        stats = self.instrumentation.snapshot()
+        stats['transport'] = self.transport_stats()
+        return stats
+
+    def request(self, method, path, params=None, data=None, timeout=10,
+                idempotent=None, **kwargs):
+        """
+        Send an authenticated request to the box and return the response.
+        The SID is added to data (if given) or the query parameters.
+        Should only be used by internal library functions.
+
+        With stream=True the body isn't read, so only a 403 is detected
+        as rejected SID.
+        Requests which aren't idempotent (by default all but GET) are
+        only retried if the connection failed, see Transport.
+        If the box has a rate limit, this waits until it allows the request.
+
+        The time until the response is read is recorded per command and
+        AIN, except for streamed responses (the caller records those).
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        sid = self.get_sid()
+        url = self.base_url + path
+        timeout = self.get_timeout(timeout)
+        stream = kwargs.get('stream')
+        if idempotent is None:
+            idempotent = method == 'GET'
+        session = self.transport.session_for(idempotent)
+        command, ain = request_command(path, params, data)
+        start = time.time()
+        try:
+            for attempt in range(2):
+                if data is not None:
+                    data = dict(data, sid=sid)
+                else:
+                    params = dict(params or {}, sid=sid)
+                response = session.request(method, url, params=params,
+                                           data=data, timeout=timeout,
+                                           **kwargs)
+                text = None if stream else response.text
+                if attempt == 0 and is_sid_rejected(response.status_code, text):
+                    response.close()
+                    sid = self.relogin(sid)
+                    continue
+                break
+            response.raise_for_status()
+        except Exception:
+            self.instrumentation.record(command, ain, time.time() - start,
+                                        error=True)
+            raise
+        if not stream:
+            self.instrumentation.record(command, ain, time.time() - start,
+                                        nbytes=len(response.content))
+        # Every request extends the lifetime of the SID
+        self._sid_expires = time.time() + self.sid_ttl
+        return response
+
     def homeautoswitch(self, cmd, ain=None, param=None):
         """
         Call a switch method.
         Should only be used by internal library functions.
-        """
-        assert self.sid, "Not logged in"
-        params = {
-            'switchcmd': cmd,
-            'sid': self.sid,
-        }
-        if param is not None:
-            params['param'] = param
-        if ain:
-            params['ain'] = sanitize_ain(ain)
 
-        url = self.base_url + '/webservices/homeautoswitch.lua'
-        response = self.session.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        return response.text.strip().encode('utf-8')
+        Concurrent calls of the same read-only command for the same AIN
+        share one request. Commands changing a device are always sent.
+        """
+        params = homeautoswitch_params(cmd, ain, param)
+        if is_mutating(cmd):
+            response = self.request('GET', '/webservices/homeautoswitch.lua',
+                                    params=params, idempotent=False)
+            self.invalidate_actors()
+            return response.text.strip().encode('utf-8')
+
+        key = tuple(sorted(params.items()))
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            response = self.request('GET', '/webservices/homeautoswitch.lua',
+                                    params=params)
+            result = response.text.strip().encode('utf-8')
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
 
     def get_switch_actors(self):
         """
@@ -192,24 +561,12 @@ class FritzBox(object):
         Return a list of devices.
         Deprecated, use get_actors instead.
         """
-        url = self.base_url + '/net/home_auto_query.lua'
-        response = self.session.get(url, params={
-            'sid': self.sid,
+        response = self.request('GET', '/net/home_auto_query.lua', params={
             'command': 'AllOutletStates',
             'xhr': 0,
         }, timeout=15)
-        response.raise_for_status()
-        data = response.json()
-        count = int(data["Outlet_count"])
-        devices = []
-        for i in range(1, count + 1):
-            device = Device(
-                int(data["DeviceID_{0}".format(i)]),
-                int(data["DeviceConnectState_{0}".format(i)]),
-                int(data["DeviceSwitchState_{0}".format(i)])
-            )
-            devices.append(device)
-        return devices
+        with self.instrumentation.parsing('AllOutletStates'):
+            return parse_devices(response.json())
 
     def get_consumption(self, deviceid, timerange="10"):
         """
@@ -219,54 +576,65 @@ class FritzBox(object):
 
         :return: dict
         """
-        tranges = ("10", "24h", "month", "year")
-        if timerange not in tranges:
-            raise ValueError(
-                "Unknown timerange. Possible values are: {0}".format(tranges)
-            )
-
-        url = self.base_url + "/net/home_auto_query.lua"
-        response = self.session.get(url, params={
-            'sid': self.sid,
+        check_timerange(timerange)
+        response = self.request('GET', '/net/home_auto_query.lua', params={
             'command': 'EnergyStats_{0}'.format(timerange),
             'id': deviceid,
             'xhr': 0,
         }, timeout=15)
-        response.raise_for_status()
 
-        data = response.json()
-        result = {}
+        with self.instrumentation.parsing('EnergyStats_{0}'.format(timerange)):
+            return parse_consumption(response.json())
 
-        # Single result values
-        values_map = {
-            'MM_Value_Amp': 'mm_value_amp',
-            'MM_Value_Power': 'mm_value_power',
-            'MM_Value_Volt': 'mm_value_volt',
-
-            'EnStats_average_value': 'enstats_average_value',
-            'EnStats_max_value': 'enstats_max_value',
-            'EnStats_min_value': 'enstats_min_value',
-            'EnStats_timer_type': 'enstats_timer_type',
-
-            'sum_Day': 'sum_day',
-            'sum_Month': 'sum_month',
-            'sum_Year': 'sum_year',
-        }
-        for avm_key, py_key in values_map.items():
-            result[py_key] = int(data[avm_key])
+    def get_consumption_series(self, deviceid, timerange="10", use_numpy=False):
+        """
+        Return the power and voltage history of the device as
+        ConsumptionSeries of arrays, oldest value first and already
+        scaled to W and V, with a timestamp for each value.
 
-        # Stats counts
-        count = int(data["EnStats_count"])
-        watt_values = [None for i in range(count)]
-        volt_values = [None for i in range(count)]
-        for i in range(1, count + 1):
-            watt_values[i - 1] = int(data["EnStats_watt_value_{}".format(i)])
-            volt_values[i - 1] = int(data["EnStats_volt_value_{}".format(i)])
+        :param use_numpy: return numpy arrays instead of array('d')
+        """
+        check_timerange(timerange)
+        response = self.request('GET', '/net/home_auto_query.lua', params={
+            'command': 'EnergyStats_{0}'.format(timerange),
+            'id': deviceid,
+            'xhr': 0,
+        }, timeout=15)
+        now = time.time()
 
-        result['watt_values'] = watt_values
-        result['volt_values'] = volt_values
+        with self.instrumentation.parsing('EnergyStats_{0}'.format(timerange)):
+            return parse_consumption_series(deviceid, timerange, response.json(),
+                                            now=now, use_numpy=use_numpy)
 
-        return result
+    def get_consumption_matrix(self, deviceids, timerange="10", use_numpy=False,
+                               max_workers=None):
+        """
+        Fetch the power history of several devices in parallel and
+        return it as ConsumptionMatrix (devices x time) for aggregates
+        like fleet totals, peaks and percentiles.
+        Devices whose history couldn't be fetched are listed in the
+        matrix's errors and have no values.
+        """
+        check_timerange(timerange)
+        deviceids = list(deviceids)
+        series = []
+        errors = {}
+        if deviceids:
+            self.get_sid()
+            workers = max(1, min(max_workers or self.max_workers, len(deviceids)))
+            self.reserve_connections(workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    (deviceid, executor.submit(self.get_consumption_series,
+                                               deviceid, timerange, use_numpy))
+                    for deviceid in deviceids
+                ]
+                for deviceid, future in futures:
+                    try:
+                        series.append(future.result())
+                    except Exception as error:
+                        errors[deviceid] = error
+        return ConsumptionMatrix(series, timerange, errors, use_numpy=use_numpy)
 
     def reset_consumption(self, deviceid):
         """
@@ -277,48 +645,276 @@ class FritzBox(object):
         :return: bool
         """
 
-        url = self.base_url + "/net/home_auto_query.lua"
-        response = self.session.post(url, data={
-            'sid': self.sid,
+        response = self.request('POST', '/net/home_auto_query.lua', data={
             'command': 'ResetEnergyData',
             'id': deviceid,
             'xhr': 0,
         }, headers={
             'Content-Type': 'application/x-www-form-urlencoded'
         }, timeout=15)
-        response.raise_for_status()
+        self.invalidate_actors()
 
-        if response.text == "":
-            raise Exception("consumption reset failed, missing user permission to change settings ?")
-
-        return response.json()["RequestResult"] == True
+        return parse_reset_result(response.text)
 
     def get_logs(self):
         """
         Return the system logs since the last reboot.
         """
-        assert BeautifulSoup, "Please install bs4 to use this method"
-
-        url = self.base_url + "/system/syslog.lua"
-        response = self.session.get(url, params={
-            'sid': self.sid,
+        response = self.request('GET', '/system/syslog.lua', params={
             'stylemode': 'print',
         }, timeout=15)
-        response.raise_for_status()
-
-        entries = []
-        tree = BeautifulSoup(response.text)
-        rows = tree.find('table').find_all('tr')
-        for row in rows:
-            columns = row.find_all("td")
-            date = columns[0].string
-            time = columns[1].string
-            message = columns[2].find("a").string
-
-            merged = "{} {} {}".format(date, time, message.encode("UTF-8"))
-            msg_hash = hashlib.md5(merged).hexdigest()
-            entries.append(LogEntry(date, time, message, msg_hash))
-        return entries
+
+        with self.instrumentation.parsing('syslog'):
+            return parse_logs(response.text)
+
+    def follow_logs(self, interval=60, seen=None, stop=None):
+        """
+        Yield new log entries, oldest first, polling the log every
+        `interval` seconds. Failed polls are logged and retried at the
+        next interval.
+
+        :param seen: SeenHashes of the entries already yielded, e.g.
+                     with a path to continue after a restart. Entries
+                     are added when yielded, the file is saved after
+                     each poll.
+        :param stop: optional threading.Event ending the generator
+        """
+        if seen is None:
+            seen = SeenHashes()
+        if stop is None:
+            stop = threading.Event()
+        last_page = None
+        while not stop.is_set():
+            try:
+                response = self.request('GET', '/system/syslog.lua', params={
+                    'stylemode': 'print',
+                }, timeout=15)
+            except Exception as error:
+                logger.warning("Polling the log failed: %s", error)
+            else:
+                # Don't parse the page again if nothing was logged
+                page = hashlib.md5(response.content).digest()
+                if page != last_page:
+                    last_page = page
+                    with self.instrumentation.parsing('syslog'):
+                        entries = parse_logs(response.text)
+                    if len(entries) > seen.max_size:
+                        seen.max_size = 2 * len(entries)
+                    new = [entry for entry in reversed(entries)
+                           if entry.hash not in seen]
+                    for entry in new:
+                        seen.add(entry.hash)
+                        yield entry
+                    if new:
+                        seen.save()
+            stop.wait(interval)
+
+
+class ActorRegistry(object):
+    """
+    Actors of one device list, indexed by (sanitized) AIN, device id
+    and name.
+    """
+
+    def __init__(self, actors=None):
+        self.timestamp = time.time() if actors is not None else None
+        # False if the actor's values (switch state, power, ...) changed
+        self.fresh = actors is not None
+        self.actors = list(actors or [])
+        self.by_ain = {}
+        self.by_device_id = {}
+        self.by_name = {}
+        for actor in actors or []:
+            self.by_ain[sanitize_ain(actor.actor_id)] = actor
+            self.by_device_id[actor.device_id] = actor
+            self.by_name[actor.name] = actor
+
+    def age(self):
+        """Seconds since the device list was fetched"""
+        if self.timestamp is None:
+            return float('inf')
+        return time.time() - self.timestamp
+
+
+#
+# Request and response handling shared by FritzBox and AsyncFritzBox
+#
+
+TIMERANGES = ("10", "24h", "month", "year")
+
+
+def calculate_response(challenge, password):
+    """Calculate response for the challenge-response authentication"""
+    to_hash = (challenge + "-" + password).encode("UTF-16LE")
+    hashed = hashlib.md5(to_hash).hexdigest()
+    return "{0}-{1}".format(challenge, hashed)
+
+
+def parse_session_info(text):
+    """
+    Parse a login_sid.lua response.
+
+    :return: tuple (sid, challenge, blocktime)
+    """
+    xml = ET.fromstring(text)
+    blocktime = xml.find('BlockTime')
+    return (
+        xml.find('SID').text,
+        xml.find('Challenge').text if xml.find('Challenge') is not None else None,
+        int(blocktime.text) if blocktime is not None else 0,
+    )
+
+
+def login_failed(blocktime):
+    """Return the exception raised for a failed login"""
+    exc = Exception("Login failed, please wait {} seconds".format(
+        blocktime
+    ))
+    exc.blocktime = blocktime
+    return exc
+
+
+def is_sid_rejected(status, text):
+    """
+    Check if the box refused a request because of an invalid or
+    expired SID.
+    """
+    if status == 403:
+        return True
+    if text is None:
+        return False
+    text = text.strip()
+    return text == SID_INVALID or \
+        "<SID>{}</SID>".format(SID_INVALID) in text
+
+
+def request_command(path, params=None, data=None):
+    """
+    Return the command and AIN (or None) of a request for the
+    instrumentation, e.g. getswitchpower or EnergyStats_24h, falling
+    back to the name of the page.
+    """
+    values = data if data is not None else (params or {})
+    command = values.get('switchcmd') or values.get('command')
+    if not command:
+        command = path.rsplit('/', 1)[-1].replace('.lua', '')
+    return command, values.get('ain')
+
+
+def is_mutating(cmd):
+    """Check if a switch command changes the state of a device"""
+    return cmd.startswith('set')
+
+
+def homeautoswitch_params(cmd, ain=None, param=None):
+    """Return the query parameters for a homeautoswitch.lua command"""
+    params = {
+        'switchcmd': cmd,
+    }
+    if param is not None:
+        params['param'] = param
+    if ain:
+        params['ain'] = sanitize_ain(ain)
+    return params
+
+
+def parse_actors(box, devices, actor_class=Actor):
+    """
+    Parse a getdevicelistinfos response into actors bound to the box.
+    """
+    if not isinstance(devices, bytes):
+        devices = devices.encode('utf-8')
+    return list(iter_parse_actors(box, BytesIO(devices), actor_class))
+
+
+def iter_parse_actors(box, source, actor_class=Actor):
+    """
+    Incrementally parse a getdevicelistinfos response from a file-like
+    object and yield its actors.
+    Every device and group is emptied once it has been parsed, so the
+    memory usage doesn't grow with the number of devices.
+    """
+    # Only listening to "end" events is faster than ET.fromstring
+    for _, element in ET.iterparse(source):
+        if element.tag == 'device':
+            yield actor_class(fritzbox=box, device=element)
+            element.clear()
+        elif element.tag == 'group':
+            element.clear()
+
+
+def parse_devices(data):
+    """Parse a AllOutletStates response into a list of devices"""
+    count = int(data["Outlet_count"])
+    devices = []
+    for i in range(1, count + 1):
+        device = Device(
+            int(data["DeviceID_{0}".format(i)]),
+            int(data["DeviceConnectState_{0}".format(i)]),
+            int(data["DeviceSwitchState_{0}".format(i)])
+        )
+        devices.append(device)
+    return devices
+
+
+def check_timerange(timerange):
+    """Raise a ValueError for unknown consumption timeranges"""
+    if timerange not in TIMERANGES:
+        raise ValueError(
+            "Unknown timerange. Possible values are: {0}".format(TIMERANGES)
+        )
+
+
+def parse_consumption(data):
+    """Parse a EnergyStats_* response, see FritzBox.get_consumption"""
+    result = {}
+
+    # Single result values
+    values_map = {
+        'MM_Value_Amp': 'mm_value_amp',
+        'MM_Value_Power': 'mm_value_power',
+        'MM_Value_Volt': 'mm_value_volt',
+
+        'EnStats_average_value': 'enstats_average_value',
+        'EnStats_max_value': 'enstats_max_value',
+        'EnStats_min_value': 'enstats_min_value',
+        'EnStats_timer_type': 'enstats_timer_type',
+
+        'sum_Day': 'sum_day',
+        'sum_Month': 'sum_month',
+        'sum_Year': 'sum_year',
+    }
+    for avm_key, py_key in values_map.items():
+        result[py_key] = int(data[avm_key])
+
+    # Stats counts
+    watt_keys, volt_keys = value_keys(int(data["EnStats_count"]))
+    result['watt_values'] = [int(data[key]) for key in watt_keys]
+    result['volt_values'] = [int(data[key]) for key in volt_keys]
+
+    return result
+
+
+def parse_reset_result(text):
+    """Parse a ResetEnergyData response"""
+    if text == "":
+        raise Exception("consumption reset failed, missing user permission to change settings ?")
+
+    return json.loads(text)["RequestResult"] == True
+
+
+def parse_logs(text):
+    """
+    Parse the syslog.lua print page into a list of LogEntry.
+    Falls back to BeautifulSoup (if installed) for unexpected markup.
+    """
+    entries = parse_log_page(text)
+    if not entries and '<td' in text.lower():
+        try:
+            return parse_log_page_bs4(text)
+        except ImportError:
+            pass
+    return entries
 
 
 def sanitize_ain(ain):
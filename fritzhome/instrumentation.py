@@ -0,0 +1,216 @@
+"""
+    Request instrumentation
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Latency histograms and counters of the requests sent to a box, per
+    command and per AIN. Network time (sending the request and reading
+    the response) and parse time are recorded separately, so a slow poll
+    can be attributed to the login, a single device or the XML parsing.
+"""
+
+from __future__ import division
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets, like the Prometheus histograms.
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Return the upper bound of the bucket containing the quantile `q`
+        (or the maximum for values above all buckets).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+        }
+
+
+class CommandStats(object):
+    """
+    Counters of a single command.
+    """
+
+    __slots__ = ('requests', 'errors', 'bytes', 'network', 'parse')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.network = Histogram()
+        self.parse = Histogram()
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'network': self.network.as_dict(),
+            'parse': self.parse.as_dict(),
+        }
+
+
+class RequestStats(object):
+    """
+    Thread-safe collection of the CommandStats of a box and the network
+    time histograms of every AIN.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.ains = {}
+            self.relogins = 0
+            self.started = time.time()
+
+    def record(self, command, ain=None, network=None, nbytes=0, error=False):
+        """Record a request and the time until its response was read"""
+        with self._lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.requests += 1
+            stats.bytes += nbytes
+            if error:
+                stats.errors += 1
+            if network is not None:
+                stats.network.observe(network)
+                if ain is not None:
+                    histogram = self.ains.get(ain)
+                    if histogram is None:
+                        histogram = self.ains[ain] = Histogram()
+                    histogram.observe(network)
+
+    def record_parse(self, command, seconds):
+        """Record the time spent parsing a response of the command"""
+        with self._lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.parse.observe(seconds)
+
+    def record_relogin(self):
+        with self._lock:
+            self.relogins += 1
+
+    @contextmanager
+    def parsing(self, command):
+        """Context manager recording its duration as parse time"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record_parse(command, time.time() - start)
+
+    def snapshot(self):
+        """Return all counters and histograms as a dict"""
+        with self._lock:
+            return {
+                'since': self.started,
+                'relogins': self.relogins,
+                'commands': dict((command, stats.as_dict())
+                                 for command, stats in self.commands.items()),
+                'ains': dict((ain, histogram.as_dict())
+                             for ain, histogram in self.ains.items()),
+            }
+
+
+class TimedReader(object):
+    """
+    File-like wrapper counting the bytes read and the time spent reading,
+    to separate network from parse time of streamed responses.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.source.read(size)
+        self.seconds += time.time() - start
+        self.bytes += len(data)
+        return data
+
+
+def format_summary(stats, slowest=5):
+    """
+    Return a human readable summary of FritzBox.stats() as list of lines.
+    """
+    def ms(value):
+        return "{:8.1f}".format(value * 1000) if value is not None else "       -"
+
+    lines = [
+        "{:<24} {:>6} {:>6} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "command", "reqs", "errors", "bytes", "net ms", "p50", "p95",
+            "max", "parse ms"),
+    ]
+    commands = sorted(stats['commands'].items(),
+                      key=lambda item: item[1]['network']['sum'], reverse=True)
+    for command, values in commands:
+        network = values['network']
+        lines.append("{:<24} {:>6} {:>6} {:>10} {} {} {} {} {}".format(
+            command, values['requests'], values['errors'], values['bytes'],
+            ms(network['sum']), ms(network['p50']), ms(network['p95']),
+            ms(network['max'] if network['count'] else None),
+            ms(values['parse']['sum'])))
+
+    ains = sorted(stats['ains'].items(), key=lambda item: item[1]['max'],
+                  reverse=True)[:slowest]
+    if ains:
+        lines.append("Slowest AINs (max / p95 ms):")
+        for ain, histogram in ains:
+            lines.append("  {:<22} {} {}".format(
+                ain, ms(histogram['max']), ms(histogram['p95'])))
+
+    transport = stats.get('transport', {})
+    lines.append("Relogins: {}, retries: {}, connections: {}, reused: {}".format(
+        stats['relogins'], transport.get('retries', 0),
+        transport.get('connections', 0), transport.get('reused', 0)))
+    return lines
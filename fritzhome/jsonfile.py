@@ -0,0 +1,57 @@
+"""
+    JSON state files
+    ~~~~~~~~~~~~~~~~
+
+    Reading and atomically replacing the small JSON files keeping state
+    between runs (SID cache, bulk fetch times, seen log entries, ...).
+"""
+
+import os
+import json
+import errno
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def read_json(path, default=None, description="state file"):
+    """
+    Return the content of a JSON file, or `default` if it doesn't
+    exist. Unreadable files are logged and ignored as well.
+    """
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError) as error:
+        if getattr(error, 'errno', None) != errno.ENOENT:
+            logger.warning("Ignoring unreadable %s %s: %s",
+                           description, path, error)
+        return default
+
+
+def write_json(path, data, private=False):
+    """
+    Replace a JSON file, creating missing directories.
+
+    The data is written to a temp file which is then renamed, so
+    concurrent readers never see a partially written file. With
+    `private`, the file and new directories are only accessible by the
+    current user.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700 if private else 0o777)
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o600 if private else 0o666)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(data, fp)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
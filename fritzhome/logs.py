@@ -0,0 +1,135 @@
+"""
+    System log helpers
+    ~~~~~~~~~~~~~~~~~~
+
+    Parsing of the syslog.lua print page, hashing of log entries and the
+    set of already seen entries used by FritzBox.follow_logs().
+
+    The page is a table with one row per entry (date, time and the
+    message in a link). parse_log_page() extracts the three cells of all
+    rows with a single regular expression instead of building a document
+    tree, which is many times faster than BeautifulSoup and needs no
+    extra package.
+"""
+
+import os
+import re
+import hashlib
+from collections import OrderedDict, namedtuple
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+from .jsonfile import read_json, write_json
+
+LogEntry = namedtuple("LogEntry", "date time message hash")
+
+# The content of a cell can't contain "</td", so a row with less than
+# three cells never matches across into the next row
+_cell = r'<td\b[^>]*>([^<]*(?:<(?!/td\b)[^<]*)*)</td\s*>\s*'
+row_pattern = re.compile(r'<tr\b[^>]*>\s*' + _cell * 3, re.I)
+link_pattern = re.compile(r'<a\b[^>]*>(.*?)</a\s*>', re.I | re.S)
+tag_pattern = re.compile(r'<[^>]*>')
+table_start = re.compile(r'<table\b', re.I)
+table_end = re.compile(r'</table\s*>', re.I)
+
+
+def cell_text(html):
+    """Return the text of a table cell's HTML"""
+    if '<' in html:
+        html = tag_pattern.sub('', html)
+    if '&' in html:
+        html = unescape(html)
+    return html
+
+
+def parse_log_page(text):
+    """
+    Parse the rows of the first table of the syslog.lua print page into
+    a list of LogEntry. Rows with less than three cells are skipped.
+    """
+    start = table_start.search(text)
+    if start is not None:
+        end = table_end.search(text, start.end())
+        text = text[start.start():end.end() if end else len(text)]
+    entries = []
+    for date, time, message in row_pattern.findall(text):
+        if '<' in message:
+            link = link_pattern.search(message)
+            if link is not None:
+                message = link.group(1)
+        date = cell_text(date)
+        time = cell_text(time)
+        message = cell_text(message)
+        entries.append(LogEntry(date, time, message, log_hash(date, time, message)))
+    return entries
+
+
+def parse_log_page_bs4(text):
+    """
+    Parse the syslog.lua print page with BeautifulSoup (needs bs4).
+    """
+    from bs4 import BeautifulSoup
+
+    entries = []
+    tree = BeautifulSoup(text, "html.parser")
+    for row in tree.find('table').find_all('tr'):
+        columns = row.find_all("td")
+        if len(columns) < 3:
+            continue
+        date = columns[0].string
+        time = columns[1].string
+        message = columns[2].find("a").string
+        entries.append(LogEntry(date, time, message, log_hash(date, time, message)))
+    return entries
+
+
+def log_hash(date, time, message):
+    """Return the MD5 hex digest identifying a log entry"""
+    merged = u"{} {} {}".format(date, time, message)
+    return hashlib.md5(merged.encode("UTF-8")).hexdigest()
+
+
+class SeenHashes(object):
+    """
+    Bounded set of the hashes of log entries already processed, the
+    oldest hashes are dropped first. If `path` is given, the set is
+    loaded from and saved to this JSON file, so following the log can
+    continue after a restart without repeating entries.
+
+    `max_size` should be well above the number of entries the box keeps,
+    otherwise entries still shown by the box are forgotten and repeated.
+    """
+
+    def __init__(self, max_size=10000, path=None):
+        self.max_size = max_size
+        self.path = os.path.expanduser(path) if path else None
+        self.hashes = OrderedDict()
+        if self.path is not None:
+            self.load()
+
+    def __contains__(self, value):
+        return value in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, value):
+        self.hashes[value] = True
+        while len(self.hashes) > self.max_size:
+            self.hashes.popitem(last=False)
+
+    def load(self):
+        hashes = read_json(self.path, [], "log state")
+        if not isinstance(hashes, list):
+            return
+        for value in hashes[-self.max_size:]:
+            self.hashes[value] = True
+
+    def save(self):
+        """Write the hashes to `path` (if given)"""
+        if self.path is None:
+            return
+        write_json(self.path, list(self.hashes))
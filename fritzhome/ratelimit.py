@@ -0,0 +1,62 @@
+"""
+    Rate limiting
+    ~~~~~~~~~~~~~
+"""
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing `rate` tokens per second with
+    bursts of up to `burst` tokens.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.waited = 0.0
+        self._last = None
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        if self._last is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if available.
+
+        :return: True if the tokens were taken
+        """
+        with self._lock:
+            self._refill()
+            if tokens > self.tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens, waiting until they are available.
+        Requests for more than `burst` tokens wait for a full bucket.
+        """
+        tokens = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                self._refill()
+                if tokens <= self.tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            self.waited += wait
+            self.sleep(wait)
@@ -0,0 +1,118 @@
+"""
+    Polling scheduler
+    ~~~~~~~~~~~~~~~~~
+
+    Runs a polling callback at wall-clock aligned boundaries (e.g. every
+    full 10 seconds) instead of sleeping a fixed time after each poll,
+    so the period doesn't drift by the time the poll takes.
+"""
+
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Calls `callback(timestamp, due)` at aligned boundaries.
+
+    `intervals` maps names (e.g. the fields to poll) to intervals in
+    seconds. Every call gets the aligned timestamp of the tick and the
+    set of names due at it, so one poll can serve several intervals::
+
+        Scheduler({'power': 5, 'energy': 60}, poll).run()
+
+    If a call takes longer than the time to the next tick, the missed
+    ticks are skipped (and counted) instead of being run back to back.
+    Exceptions of the callback are logged and counted, the next tick
+    runs as usual.
+    """
+
+    def __init__(self, intervals, callback, clock=time.time):
+        if not isinstance(intervals, dict):
+            intervals = {None: intervals}
+        for name, interval in intervals.items():
+            if interval <= 0:
+                raise ValueError("Interval of {} must be positive".format(name))
+        self.intervals = intervals
+        self.callback = callback
+        self.clock = clock
+
+        self.ticks = 0
+        self.overruns = 0
+        self.errors = 0
+        self.skipped = dict((name, 0) for name in intervals)
+        self._next_due = None
+        self._stop = threading.Event()
+
+    def stats(self):
+        """Return the tick, overrun, error and skipped tick counters"""
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'errors': self.errors,
+            'skipped': dict(self.skipped),
+        }
+
+    def stop(self):
+        """Stop run() after the current tick"""
+        self._stop.set()
+
+    def next_tick(self):
+        """
+        Return the timestamp of the next tick.
+        """
+        if self._next_due is None:
+            now = self.clock()
+            self._next_due = dict(
+                (name, (math.floor(now / interval) + 1) * interval)
+                for name, interval in self.intervals.items()
+            )
+        return min(self._next_due.values())
+
+    def run_pending(self):
+        """
+        Run the callback if a tick is due.
+
+        :return: True if the callback was called
+        """
+        now = self.clock()
+        if self.next_tick() > now:
+            return False
+
+        # Coalesce missed ticks into the latest boundary that has passed
+        due = set()
+        for name, next_due in self._next_due.items():
+            if next_due <= now:
+                interval = self.intervals[name]
+                missed = int((now - next_due) // interval)
+                if missed:
+                    self.skipped[name] += missed
+                    next_due += missed * interval
+                    self._next_due[name] = next_due
+                due.add(name)
+        timestamp = max(self._next_due[name] for name in due)
+
+        try:
+            self.callback(timestamp, due)
+        except Exception as error:
+            self.errors += 1
+            logger.warning("Tick %s failed: %s", timestamp, error)
+        self.ticks += 1
+        for name in due:
+            self._next_due[name] += self.intervals[name]
+        if self.clock() > self.next_tick():
+            self.overruns += 1
+            logger.warning("Tick %s took longer than the interval", timestamp)
+        return True
+
+    def run(self):
+        """
+        Run the callback at every tick until stop() is called.
+        """
+        while not self._stop.is_set():
+            if not self.run_pending():
+                self._stop.wait(max(0, self.next_tick() - self.clock()))
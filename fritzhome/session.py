@@ -0,0 +1,51 @@
+"""
+    SID cache
+    ~~~~~~~~~
+
+    Stores SIDs on disk so short-lived processes (e.g. the CLI started
+    by cron) can reuse a session instead of logging in every time.
+"""
+
+import os
+
+from .jsonfile import read_json, write_json
+
+
+class SessionCache(object):
+    """
+    A JSON file mapping host and username to the last known SID.
+    The file is only readable by the current user, as a SID grants
+    the same access as the password.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def key(self, host, username):
+        """Return the cache key for a box and user"""
+        return "{}@{}".format(username, host)
+
+    def get(self, host, username):
+        """
+        Return the cached SID or None.
+        """
+        return self._read().get(self.key(host, username))
+
+    def set(self, host, username, sid):
+        """
+        Store a SID, or remove it if sid is None.
+        """
+        data = self._read()
+        key = self.key(host, username)
+        if sid is None:
+            data.pop(key, None)
+        else:
+            data[key] = sid
+        self._write(data)
+
+    def _read(self):
+        data = read_json(self.path, {}, "session cache")
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data):
+        write_json(self.path, data, private=True)
@@ -0,0 +1,462 @@
+"""
+    Time series store
+    ~~~~~~~~~~~~~~~~~
+
+    An embedded, append-only store for the readings of the polled
+    actors, answering questions like "kWh per device last month" without
+    a time series database::
+
+        store = TimeSeriesStore("~/.fritzhome/store")
+        store.append(box.get_readings())
+        ...
+        store.query(ain, 'energy', start, end, aggregate='increase')
+
+    Layout: one directory per actor (named by its sanitized AIN) with
+    one directory per field, holding one segment file per UTC day.
+    A segment is a sequence of (timestamp, value) entries, each stored
+    as the zigzag varint encoded difference to the previous entry (the
+    first entry of a segment is relative to zero). Values are integers:
+    power in mW, energy in Wh, temperature in 0.1 °C, state and present
+    as 0/1. A run of unchanged values costs two bytes per entry.
+
+    Segments are read through mmap. Per segment summaries (count, sum,
+    min, max, first, last and counter increase) are cached next to the
+    segments, so aggregates over whole days don't decode them again.
+
+    Only one process may write to a store at a time.
+"""
+
+from __future__ import division
+
+import os
+import json
+import time
+import mmap
+import errno
+import logging
+
+from .fritz import sanitize_ain
+from .jsonfile import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Stored fields of a Reading and the factor of their integer encoding
+FIELD_SCALES = {
+    'power': 1,
+    'energy': 1,
+    'temperature': 10,
+    'state': 1,
+    'present': 1,
+}
+
+SEGMENT_SECONDS = 86400
+
+AGGREGATES = ('mean', 'min', 'max', 'sum', 'count', 'first', 'last', 'increase')
+
+
+def encode_varint(value, out):
+    """Append the zigzag varint encoding of an integer to a bytearray"""
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_entries(data, size):
+    """
+    Decode the entries of a segment.
+
+    :return: (timestamps, values, offset after the last complete entry),
+             a truncated entry at the end (e.g. after a crash) is ignored
+    """
+    timestamps = []
+    values = []
+    pos = complete = 0
+    timestamp = value = 0
+    while True:
+        # Timestamp difference
+        result = shift = 0
+        while pos < size:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        else:
+            break
+        timestamp += (result >> 1) ^ -(result & 1)
+        # Value difference
+        result = shift = 0
+        while pos < size:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        else:
+            break
+        value += (result >> 1) ^ -(result & 1)
+        timestamps.append(timestamp)
+        values.append(value)
+        complete = pos
+    return timestamps, values, complete
+
+
+def read_segment(path):
+    """Return the timestamps and values of a segment file"""
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if not size:
+            return [], []
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if bytes is str:
+                # Python 2 indexes mmaps as strings
+                data = bytearray(data)
+            timestamps, values, _ = decode_entries(data, size)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return timestamps, values
+
+
+def counter_rise(previous, value):
+    """
+    Return the increase of a counter between two entries; a drop counts
+    as a counter reset, adding the new value.
+    """
+    return value - previous if value >= previous else value
+
+
+def summarize(timestamps, values):
+    """
+    Return the summary [count, sum, min, max, first_ts, first, last_ts,
+    last, increase] of entries, or None without entries.
+    The increase is the sum of all rises; a drop counts as a counter
+    reset, adding the new value.
+    """
+    if not values:
+        return None
+    increase = 0
+    previous = values[0]
+    for value in values:
+        increase += counter_rise(previous, value)
+        previous = value
+    return [len(values), sum(values), min(values), max(values),
+            timestamps[0], values[0], timestamps[-1], values[-1], increase]
+
+
+def merge(first, second):
+    """Merge two summaries, `second` following `first` in time"""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return [first[0] + second[0], first[1] + second[1],
+            min(first[2], second[2]), max(first[3], second[3]),
+            first[4], first[5], second[6], second[7],
+            first[8] + second[8] + counter_rise(first[7], second[5])]
+
+
+def aggregate_summary(summary, aggregate):
+    """Return an aggregate of a summary (in the integer encoding)"""
+    count, total, minimum, maximum, _, first, _, last, increase = summary
+    return {
+        'mean': total / count,
+        'min': minimum,
+        'max': maximum,
+        'sum': total,
+        'count': count,
+        'first': first,
+        'last': last,
+        'increase': increase,
+    }[aggregate]
+
+
+class TimeSeriesStore(object):
+    """
+    Append-only store of actor readings below the directory `path`.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        # (ain, field) to the day and last (timestamp, value) of the
+        # newest segment written to, older segments are read again if
+        # a late value arrives
+        self._tails = {}
+        self._names = {}
+        self._summaries = {}
+
+    def _directory(self, ain, field=None):
+        parts = [self.path, sanitize_ain(ain)]
+        if field is not None:
+            parts.append(field)
+        return os.path.join(*parts)
+
+    #
+    # Writing
+    #
+
+    def append(self, readings, names=None):
+        """
+        Store the known values of readings.
+        Values older than the last stored value of the same field are
+        dropped, as the store is append-only.
+
+        :param names: optional dict of AIN to actor name for devices()
+        :return: number of stored values
+        """
+        entries = {}
+        for reading in readings:
+            if names and reading.ain in names:
+                self._set_name(reading.ain, names[reading.ain])
+            timestamp = int(reading.timestamp)
+            for field, scale in FIELD_SCALES.items():
+                value = getattr(reading, field)
+                if value is None:
+                    continue
+                key = (reading.ain, field, timestamp // SEGMENT_SECONDS)
+                entries.setdefault(key, []).append(
+                    (timestamp, int(round(value * scale))))
+
+        stored = 0
+        for key, values in entries.items():
+            stored += self._write(key, values)
+        return stored
+
+    def _write(self, key, values):
+        ain, field, day = key
+        directory = self._directory(ain, field)
+        path = os.path.join(directory, "{}.seg".format(day))
+        current = self._tails.get((ain, field))
+        if current is not None and current[0] == day:
+            tail = current[1]
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tail = self._open_tail(path)
+
+        out = bytearray()
+        written = 0
+        last_timestamp, last_value = tail
+        for timestamp, value in sorted(values):
+            if last_timestamp is not None and timestamp <= last_timestamp:
+                continue
+            encode_varint(timestamp - (last_timestamp or 0), out)
+            encode_varint(value - (last_value or 0), out)
+            last_timestamp, last_value = timestamp, value
+            written += 1
+        if out:
+            with open(path, 'ab') as fp:
+                fp.write(out)
+        if current is None or day >= current[0]:
+            self._tails[(ain, field)] = (day, (last_timestamp, last_value))
+        return written
+
+    def _open_tail(self, path):
+        # Last entry of an existing segment; cut off a partially written
+        # entry, so new entries don't continue it
+        if not os.path.exists(path):
+            return (None, None)
+        with open(path, 'rb') as fp:
+            data = bytearray(fp.read())
+        timestamps, values, complete = decode_entries(data, len(data))
+        if complete < len(data):
+            logger.warning("Truncating incomplete entry at the end of %s", path)
+            with open(path, 'r+b') as fp:
+                fp.truncate(complete)
+        if not timestamps:
+            return (None, None)
+        return (timestamps[-1], values[-1])
+
+    def _set_name(self, ain, name):
+        if self._names.get(ain) == name:
+            return
+        directory = self._directory(ain)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "meta.json"), 'w') as fp:
+            json.dump({'ain': ain, 'name': name}, fp)
+        self._names[ain] = name
+
+    #
+    # Reading
+    #
+
+    def devices(self):
+        """Return a dict of the stored AINs to their names (or None)"""
+        devices = {}
+        try:
+            entries = os.listdir(self.path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return devices
+        for entry in sorted(entries):
+            try:
+                with open(os.path.join(self.path, entry, "meta.json")) as fp:
+                    meta = json.load(fp)
+                devices[meta['ain']] = meta.get('name')
+            except (IOError, OSError, ValueError, KeyError):
+                if os.path.isdir(os.path.join(self.path, entry)):
+                    devices[entry] = None
+        return devices
+
+    def _segments(self, ain, field, start, end):
+        # Days of the segments overlapping [start, end)
+        directory = self._directory(ain, field)
+        try:
+            names = os.listdir(directory)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return []
+        days = sorted(int(name[:-4]) for name in names if name.endswith('.seg'))
+        return [
+            (day, os.path.join(directory, "{}.seg".format(day))) for day in days
+            if (start is None or (day + 1) * SEGMENT_SECONDS > start) and
+            (end is None or day * SEGMENT_SECONDS < end)
+        ]
+
+    def read(self, ain, field, start=None, end=None):
+        """
+        Return the stored values of a field in [start, end) as list of
+        (timestamp, value).
+        """
+        check_field(field)
+        points = []
+        for _, path in self._segments(ain, field, start, end):
+            timestamps, values = read_segment(path)
+            points.extend(
+                (timestamp, scale_value(field, value))
+                for timestamp, value in zip(timestamps, values)
+                if (start is None or timestamp >= start) and
+                (end is None or timestamp < end)
+            )
+        return points
+
+    def query(self, ain, field, start=None, end=None, step=None,
+              aggregate=None):
+        """
+        Return the values of a field in [start, end) as list of
+        (timestamp, value).
+
+        Without step and aggregate, all stored values are returned. With
+        a step (seconds), the values are downsampled to one aggregate per
+        step (default: mean), timestamped with the start of the step.
+        With an aggregate but no step, it's computed over the whole range.
+
+        Aggregates are those of AGGREGATES. 'increase' is meant for the
+        energy counter: the consumed Wh, counting through resets. The rise
+        from the last entry of a step to the first of the next one counts
+        to the later step, so the steps add up to the whole range.
+        """
+        check_field(field)
+        if step is None and aggregate is None:
+            return self.read(ain, field, start, end)
+        aggregate = aggregate or 'mean'
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate {}, possible values are: {}".format(
+                aggregate, AGGREGATES))
+
+        def bucket(timestamp):
+            return timestamp - timestamp % step if step else 0
+
+        buckets = {}
+        for day, path in self._segments(ain, field, start, end):
+            segment_start = day * SEGMENT_SECONDS
+            whole = (start is None or start <= segment_start) and \
+                (end is None or segment_start + SEGMENT_SECONDS <= end)
+            if whole and (not step or step % SEGMENT_SECONDS == 0):
+                # The segment lies within a single bucket
+                key = bucket(segment_start)
+                buckets[key] = merge(buckets.get(key),
+                                     self._segment_summary(ain, field, day, path))
+                continue
+
+            timestamps, values = read_segment(path)
+            groups = {}
+            for timestamp, value in zip(timestamps, values):
+                if (start is None or timestamp >= start) and \
+                        (end is None or timestamp < end):
+                    group = groups.setdefault(bucket(timestamp), ([], []))
+                    group[0].append(timestamp)
+                    group[1].append(value)
+            for key in sorted(groups):
+                buckets[key] = merge(buckets.get(key), summarize(*groups[key]))
+
+        results = []
+        previous = None
+        for key in sorted(buckets):
+            summary = buckets[key]
+            if summary is None:
+                continue
+            value = aggregate_summary(summary, aggregate)
+            if aggregate == 'increase' and previous is not None:
+                value += counter_rise(previous[7], summary[5])
+            previous = summary
+            if aggregate != 'count':
+                value = scale_value(field, value,
+                                    aggregate in ('mean', 'sum', 'increase'))
+            results.append((key if step else summary[4], value))
+        return results
+
+    def _segment_summary(self, ain, field, day, path):
+        # Cached summary of a segment, valid as long as its size is unchanged
+        cache_key = (ain, field)
+        cache = self._summaries.get(cache_key)
+        cache_path = os.path.join(self._directory(ain, field), "summary.json")
+        if cache is None:
+            cache = read_json(cache_path, {}, "summary cache")
+            self._summaries[cache_key] = cache
+
+        size = os.path.getsize(path)
+        entry = cache.get(str(day))
+        if entry is not None and entry[0] == size:
+            return entry[1]
+        summary = summarize(*read_segment(path))
+        cache[str(day)] = [size, summary]
+        try:
+            write_json(cache_path, cache)
+        except (IOError, OSError) as error:
+            logger.warning("Writing %s failed: %s", cache_path, error)
+        return summary
+
+
+def parse_duration(value):
+    """Parse a duration like 90, 15m, 12h or 30d into seconds"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def parse_time(value, now):
+    """
+    Parse a point in time: a duration before now (30d), a date
+    (2024-01-31, local time) or a unix timestamp.
+    """
+    if '-' in value:
+        return int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+    if value[-1].isdigit() and float(value) > 10 ** 9:
+        return int(float(value))
+    return int(now) - parse_duration(value)
+
+
+def check_field(field):
+    if field not in FIELD_SCALES:
+        raise ValueError("Unknown field {}, possible values are: {}".format(
+            field, ", ".join(sorted(FIELD_SCALES))))
+
+
+def scale_value(field, value, fraction=False):
+    """Convert a value from the integer encoding"""
+    scale = FIELD_SCALES[field]
+    if scale != 1:
+        return value / scale
+    if field in ('state', 'present') and not fraction:
+        return bool(value)
+    return value
@@ -0,0 +1,147 @@
+"""
+    HTTP transport
+    ~~~~~~~~~~~~~~
+
+    requests session setup used by FritzBox: connection pools sized for
+    the number of parallel requests and retries with jittered backoff
+    for idempotent requests.
+"""
+
+import random
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class JitteredRetry(Retry):
+    """
+    Retry policy with "full jitter": the wait before each retry is a
+    random value between 0 and the exponential backoff, so several
+    clients don't hit a recovering box at the same time.
+    Counts the retries in the shared `counters` dict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.counters = kwargs.pop('counters', None)
+        if self.counters is None:
+            self.counters = {'retries': 0}
+        super(JitteredRetry, self).__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        kwargs.setdefault('counters', self.counters)
+        return super(JitteredRetry, self).new(**kwargs)
+
+    def increment(self, *args, **kwargs):
+        # Raises once the retries are exhausted, so only real retries count
+        retry = super(JitteredRetry, self).increment(*args, **kwargs)
+        self.counters['retries'] += 1
+        return retry
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+class Transport(object):
+    """
+    Creates and tracks the HTTP sessions of a box.
+
+    `session` retries idempotent requests (GET, ...) after connection
+    errors, read timeouts and 502/503/504 answers. `once_session` only
+    retries if the connection couldn't be established, so the request
+    never reached the box. It's used for requests which must not be
+    repeated: commands changing a device (which are GETs, too), the
+    login response (the challenge is only valid once, a repeated wrong
+    response blocks the login) and POST requests like ResetEnergyData.
+    """
+
+    def __init__(self, pool_size=4, retries=2, backoff=0.5):
+        self.counters = {'retries': 0}
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        # Counters of connection pools replaced by ensure_pool_size()
+        self._closed = {'requests': 0, 'connections': 0}
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=JitteredRetry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+                counters=self.counters,
+            ),
+        )
+        self.once_adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=JitteredRetry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=0,
+                backoff_factor=backoff,
+                raise_on_status=False,
+                counters=self.counters,
+            ),
+        )
+        self.session = self._session(self.adapter)
+        self.once_session = self._session(self.once_adapter)
+
+    def _session(self, adapter):
+        session = Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session_for(self, idempotent):
+        """Return the session to send a (non-)idempotent request with"""
+        return self.session if idempotent else self.once_session
+
+    def ensure_pool_size(self, size):
+        """
+        Grow the connection pools to keep at least `size` connections
+        open, e.g. before running that many requests in parallel.
+        Open connections are closed when the pools are replaced.
+        """
+        with self._lock:
+            if size <= self.pool_size:
+                return
+            for adapter in (self.adapter, self.once_adapter):
+                for key, value in self._pool_stats(adapter).items():
+                    self._closed[key] += value
+                adapter.poolmanager.clear()
+                adapter.init_poolmanager(1, size)
+            self.pool_size = size
+
+    def _pool_stats(self, adapter):
+        stats = {'requests': 0, 'connections': 0}
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+        return stats
+
+    def stats(self):
+        """
+        Return the number of requests, newly opened connections and
+        requests that reused an open (keep-alive) connection.
+        """
+        with self._lock:
+            requests = self._closed['requests']
+            connections = self._closed['connections']
+            for adapter in (self.adapter, self.once_adapter):
+                stats = self._pool_stats(adapter)
+                requests += stats['requests']
+                connections += stats['connections']
+        return {
+            'requests': requests,
+            'connections': connections,
+            'reused': max(0, requests - connections),
+            'retries': self.counters['retries'],
+        }
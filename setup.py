@@ -43,8 +43,14 @@ setup(
     install_requires=[
         'requests>=2.12.0',
         'click>=6.0.0',
+        'futures>=3.0; python_version < "3"',
     ],
 
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+        'numpy': ['numpy'],
+    },
+
     entry_points={
         'console_scripts': [
             'fritzhome=fritzhome.__main__:cli',
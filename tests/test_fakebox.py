@@ -0,0 +1,319 @@
+"""
+    Regression tests against the FakeBox
+"""
+
+import time
+import random
+import threading
+
+import pytest
+import requests
+
+from fritzhome.actor import Reading
+from fritzhome.adaptive import AdaptivePoller
+from fritzhome.fakebox import FakeBox, FakeDevice, fake_logs, syslog_page
+from fritzhome.fritz import FritzBox, sanitize_ain
+from fritzhome.logs import log_hash, parse_log_page
+from fritzhome.scheduler import Scheduler
+from fritzhome.store import TimeSeriesStore
+
+
+@pytest.fixture
+def box():
+    with FakeBox(devices=12, seed=0) as fake:
+        yield fake
+
+
+def connect(box, **kwargs):
+    return FritzBox(box.host, box.username, box.password, **kwargs)
+
+
+def outlets(box):
+    return [device.ain for device in box.devices if not device.is_hkr]
+
+
+#
+# Login
+#
+
+def test_login(box):
+    fritz = connect(box)
+    sid = fritz.get_sid()
+    assert sid in box.sids
+    assert fritz.get_sid() == sid
+    # Challenge and response
+    assert box.requests['login'] == 2
+
+
+def test_login_failed(box):
+    fritz = FritzBox(box.host, box.username, "wrong")
+    with pytest.raises(Exception) as info:
+        fritz.login()
+    assert info.value.blocktime >= 1
+
+
+def test_shared_relogin(box):
+    fritz = connect(box, max_workers=6)
+    fritz.get_sid()
+    logins = box.requests['login']
+    # The box forgets all sessions, e.g. after a reboot
+    box.sids.clear()
+
+    results = fritz.query_many('getswitchpower', outlets(box))
+    assert all(result.error is None for result in results.values())
+    assert fritz.stats()['relogins'] == 1
+    assert box.requests['login'] - logins == 2
+
+
+#
+# Transport
+#
+
+def test_mutating_command_not_repeated(box):
+    fritz = connect(box, timeout=0.2, backoff=0)
+    fritz.get_sid()
+    device = box.devices[0]
+    state = device.state
+    box.latency = 0.5
+
+    with pytest.raises(requests.RequestException):
+        fritz.set_switch_toggle(device.ain)
+    # Wait for the box to handle the request and possible retries
+    time.sleep(1.0)
+    assert box.requests['setswitchtoggle'] == 1
+    assert device.state != state
+
+
+def test_read_timeout_retried(box):
+    fritz = connect(box, timeout=0.2, backoff=0, retries=2)
+    fritz.get_sid()
+    box.latency = 0.5
+
+    with pytest.raises(requests.RequestException):
+        fritz.homeautoswitch('getswitchpower', box.devices[0].ain)
+    time.sleep(0.6)
+    assert box.requests['getswitchpower'] == 3
+
+
+def test_pool_sized_from_workers(box):
+    fritz = connect(box)
+    fritz.query_actors(outlets(box), max_workers=8)
+    assert fritz.transport.pool_size >= 10
+
+
+def test_concurrent_reads_coalesced(box):
+    fritz = connect(box)
+    fritz.get_sid()
+    box.latency = 0.2
+    ain = box.devices[0].ain
+
+    results = []
+
+    def query():
+        results.append(fritz.homeautoswitch('getswitchpower', ain))
+
+    threads = [threading.Thread(target=query) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 5
+    assert len(set(results)) == 1
+    assert box.requests['getswitchpower'] == 1
+
+
+#
+# Polling
+#
+
+def test_adaptive_poller_small_budget(box):
+    clock = [0.0]
+    fritz = connect(box)
+    poller = AdaptivePoller(fritz, fritz.get_actors(), min_interval=2,
+                            budget=0.5, clock=lambda: clock[0])
+    for _ in range(12):
+        poller.poll()
+        clock[0] += 2
+    # Outlets need four requests, more than the budget of one interval
+    assert any(schedule.polls for schedule in poller.schedules
+               if len(schedule.fields) == 4)
+
+
+def test_scheduler_survives_errors():
+    clock = [0.5]
+    calls = []
+
+    def callback(timestamp, due):
+        calls.append(timestamp)
+        raise IOError("503 Service Unavailable")
+
+    scheduler = Scheduler(1, callback, clock=lambda: clock[0])
+    for _ in range(3):
+        clock[0] += 1
+        scheduler.run_pending()
+    assert len(calls) == 2
+    assert scheduler.stats()['errors'] == 2
+
+
+#
+# Store
+#
+
+AIN = "087610000001"
+START = 86400 * 20000
+
+
+def hourly_readings(hours):
+    return [
+        Reading(AIN, START + hour * 3600, 1500 + hour, 1000 + hour * 10,
+                21.5, hour % 2 == 0, True)
+        for hour in range(hours)
+    ]
+
+
+def test_store_round_trip(tmpdir):
+    readings = hourly_readings(72)
+    store = TimeSeriesStore(str(tmpdir))
+    assert store.append(readings, {AIN: "Steckdose 1"}) == 72 * 5
+    # Older values are dropped
+    assert store.append(readings[:1]) == 0
+
+    store = TimeSeriesStore(str(tmpdir))
+    assert store.devices() == {AIN: "Steckdose 1"}
+    assert store.read(AIN, 'power') == [
+        (reading.timestamp, reading.power) for reading in readings]
+    assert store.read(AIN, 'temperature')[0] == (START, 21.5)
+    assert store.read(AIN, 'state')[:2] == [(START, True), (START + 3600, False)]
+    assert store.query(AIN, 'power', aggregate='max') == [(START, 1571)]
+
+
+def test_store_keeps_only_newest_tails(tmpdir):
+    store = TimeSeriesStore(str(tmpdir))
+    for reading in hourly_readings(72):
+        store.append([reading])
+    assert len(store._tails) == 5
+    assert set(day for day, _ in store._tails.values()) == {START // 86400 + 2}
+    # A late value of an earlier day is still stored
+    assert store.append([Reading(AIN, START + 23 * 3600 + 1800, 1, None, None, None, None)]) == 1
+    assert len(store._tails) == 5
+    assert (START + 23 * 3600 + 1800, 1) in store.read(AIN, 'power')
+
+
+def test_store_increase(tmpdir):
+    store = TimeSeriesStore(str(tmpdir))
+    store.append(hourly_readings(72))
+
+    assert store.query(AIN, 'energy', aggregate='increase') == [(START, 710)]
+    days = store.query(AIN, 'energy', step=86400, aggregate='increase')
+    assert [value for _, value in days] == [230, 240, 240]
+    hours = store.query(AIN, 'energy', step=3600, aggregate='increase')
+    assert sum(value for _, value in hours) == 710
+    assert [value for _, value in hours[1:]] == [10] * 71
+
+
+def test_store_increase_reset(tmpdir):
+    store = TimeSeriesStore(str(tmpdir))
+    store.append([
+        Reading(AIN, START + hour * 3600, None, energy, None, None, None)
+        for hour, energy in enumerate((100, 150, 20, 40))
+    ])
+    hours = store.query(AIN, 'energy', step=3600, aggregate='increase')
+    assert [value for _, value in hours] == [0, 50, 20, 20]
+
+
+#
+# System log
+#
+
+def test_parse_log_page():
+    logs = fake_logs(30)
+    entries = parse_log_page(syslog_page(logs))
+    assert [(entry.date, entry.time, entry.message) for entry in entries] == \
+        [tuple(log) for log in reversed(logs)]
+    for entry in entries:
+        assert entry.hash == log_hash(entry.date, entry.time, entry.message)
+
+
+def test_parse_log_page_markup():
+    page = (
+        '<html><TABLE class=x><tr><th>Datum</th></tr>\n'
+        '<TR class="a"><TD>17.10.26</TD><td>10:00:00</td>'
+        '<td><A href=\'#x\'>A &amp; B &lt;c&gt;</A ></td></TR>\n'
+        '<tr><td>1</td><td>2</td></tr>\n'
+        '<tr><td>17.10.26</td><td>09:00:00</td><td>no link</td></tr>'
+        '</TABLE><table><tr><td>x</td><td>y</td><td>z</td></tr></table>'
+    )
+    entries = parse_log_page(page)
+    assert [(entry.date, entry.time, entry.message) for entry in entries] == [
+        ("17.10.26", "10:00:00", "A & B <c>"),
+        ("17.10.26", "09:00:00", "no link"),
+    ]
+
+
+def test_get_logs(box):
+    fritz = connect(box)
+    entries = fritz.get_logs()
+    assert len(entries) == len(box.logs)
+    assert entries[0].message == box.logs[-1][2]
+
+
+#
+# Device list cache
+#
+
+def add_device(box):
+    device = FakeDevice(len(box.devices), random.Random(0))
+    box.devices.append(device)
+    box.by_ain[sanitize_ain(device.ain)] = device
+    box.by_id[str(device.device_id)] = device
+    return device
+
+
+def test_device_list_cached(box):
+    fritz = connect(box, cache_ttl=60)
+    first = fritz.get_actors()
+    assert fritz.get_actors() == first
+    assert box.requests['getdevicelistinfos'] == 1
+    fritz.get_actors(max_age=0)
+    assert box.requests['getdevicelistinfos'] == 2
+
+
+@pytest.mark.parametrize('change', [
+    lambda fritz, box: fritz.set_switch_on(box.devices[0].ain),
+    lambda fritz, box: fritz.set_switch_off(box.devices[0].ain),
+    lambda fritz, box: fritz.set_switch_toggle(box.devices[0].ain),
+    lambda fritz, box: fritz.homeautoswitch('sethkrtsoll', box.devices[9].ain, 40),
+    lambda fritz, box: fritz.reset_consumption(box.devices[0].device_id),
+])
+def test_device_list_invalidated(box, change):
+    fritz = connect(box, cache_ttl=60)
+    fritz.get_actors()
+    change(fritz, box)
+    fritz.get_actors()
+    assert box.requests['getdevicelistinfos'] == 2
+
+
+def test_device_list_invalidated_during_download(box):
+    fritz = connect(box, cache_ttl=60)
+    device = box.devices[0]
+    device.state = False
+    actors = fritz.iter_actors()
+    next(actors)
+    # Switched after the box sent the list, before it was parsed
+    fritz.set_switch_on(device.ain)
+    list(actors)
+
+    actor = fritz.get_actors()[0]
+    assert box.requests['getdevicelistinfos'] == 2
+    assert actor.state is True
+
+
+def test_lookup_miss_refreshes(box):
+    fritz = connect(box, cache_ttl=60)
+    fritz.get_actors()
+    device = add_device(box)
+    actor = fritz.get_actor_by_ain(device.ain)
+    assert actor is not None and actor.name == device.name
+    # Known actors are found without downloading the list again
+    assert fritz.get_actor_by_ain(box.devices[0].ain) is not None
+    assert box.requests['getdevicelistinfos'] == 2